@@ -36,15 +36,44 @@ from datetime import datetime as dt
 from datetime import timedelta as delt
 import random
 import gzip
-from netCDF4 import num2date, date2num
+from time import time
+
+# EDIT by JT: pyarrow parses the CSVs multithreaded, pandas' C engine is the
+#  fallback if it isn't available
+try:
+    from pyarrow import csv as pa_csv, input_stream, concat_tables
+    import pyarrow as pa
+except ImportError:
+    pa = None
 
 input_dir = '/scratch/hd50/barra2/data/obs/'
 input_dir = '/scratch/hd50/jt4085/jma_wind/'
 infile_template = input_dir + '$instrument/%Y%m/%d/%H/$coverage/*$CHANNEL*.gz'
 _platforms = ['MTSAT-2', 'MTSAT-1R', 'GOES-9', 'GMS-5']
 _time_units = 'days since 1858-11-17 00:00:00'
+# The MJD epoch from _time_units and the number of ms per day
+_time_epoch = np.datetime64('1858-11-17T00:00:00', 'ms')
+_ms_per_day = 86400 * 1000
 _channels = ['VIS', 'IR1', 'IR2', 'IR3', 'IR4']
+# The CSV columns and their types, all are used by winds_csv_to_bufr.
+#  All are float64, the encoder's codes_set_array only sets Python floats
+#  (which float64 is, float32 isn't) as doubles, anything else as longs.
+_csv_dtypes = {'lon(deg.)': np.float64,
+               'lat(deg.)': np.float64,
+               'height(hPa)': np.float64,
+               'time(mjd)': np.float64,
+               'QI using NWP': np.float64,
+               'QI not using NWP': np.float64,
+               'u (m/s)': np.float64,
+               'v (m/s)': np.float64,
+               'satzenithangle(deg.)': np.float64}
+_coverages = ['s', 'f', 'a']
 _tempdir = '/scratch/hd50/%s' % os.environ['USER']
+# EDIT by JT: parsed CSVs are cached as .npz, one per channel in each
+#  platform/yyyymm/dd/hh/coverage directory, mirroring input_dir
+_cache_dir = os.path.join(_tempdir, 'jma_wind_cache')
+# EDIT by JT: an inventory of every file under input_dir, see FileInventory
+_inventory_path = os.path.join(_cache_dir, 'inventory.csv')
 
 def find_closest_basetime(t):
     # Data is organised as 0, 6, 12, and 18
@@ -62,22 +91,30 @@ def find_closest_basetime(t):
 
     return bt
 
-def find_all_files(platform, channel, tstart, tend):
+def _datetime_to_seconds(t):
+    # Seconds since the unix epoch of a timezone naive datetime
+    return np.datetime64(t, 's').astype(np.int64)
+
+def find_all_files(platform, channel, tstart, tend, inventory=None):
     """
     Return all the files available for given platform, between the given time period.
     find_all_files('MTSAT-1R', 'VIS', dt(2010, 7, 30, 21), dt(2010, 7, 31, 3))
+    If a FileInventory is given it's searched rather than globbing input_dir.
     """
 
     assert platform in _platforms, "ERROR: Current implemented for {:} only".format(_platforms)
     assert channel in _channels, "ERROR: Current implemented for {:} only".format(_channels)
 
+    if inventory is not None:
+        return inventory.find_files(platform, channel, tstart, tend)
+
     infile_templ = infile_template.replace('$instrument', platform).replace('$CHANNEL', channel)
     file_start = find_closest_basetime(tstart)
     file_end = find_closest_basetime(tend)
     file_datetimes = pd.date_range(file_start, file_end, freq='6H')
 
     files_included = {}
-    for coverage in ['s', 'f', 'a']:
+    for coverage in _coverages:
         files_subset = []
         for datetime in file_datetimes:
             #print("Doing {:}".format(datetime))
@@ -90,41 +127,375 @@ def find_all_files(platform, channel, tstart, tend):
 
     return files_included
 
-def get_wind_data(platform, channel, tstart, tend):
+def _get_channel(file_name):
+    # The channel in a file name, as matched by *$CHANNEL* in infile_template
+    for channel in _channels:
+        if channel in file_name:
+            return channel
+
+    return None
+
+def _scan_dirs(path):
+    # Sorted sub-directories of path
+    try:
+        return sorted((e for e in os.scandir(path) if e.is_dir()),
+                      key=lambda e: e.name)
+    except FileNotFoundError:
+        return []
+
+def _scan_month(platform, month_dir):
+    """
+    Return (platform, channel, coverage, basetime, path) for every file in a
+    platform's yyyymm directory.
+    """
+    rows = []
+    for day_dir in _scan_dirs(month_dir.path):
+        for hour_dir in _scan_dirs(day_dir.path):
+            try:
+                basetime = dt.strptime(month_dir.name + day_dir.name + hour_dir.name,
+                                       '%Y%m%d%H')
+            except ValueError:
+                continue
+
+            for coverage_dir in _scan_dirs(hour_dir.path):
+                for f in sorted(os.scandir(coverage_dir.path), key=lambda e: e.name):
+                    channel = _get_channel(f.name)
+                    if channel is None or not f.name.endswith('.gz') or not f.is_file():
+                        continue
+
+                    rows.append((platform, channel, coverage_dir.name, basetime, f.path))
+
+    return rows
+
+def _month_mtime(month_dir):
+    """
+    The latest mtime of a platform's yyyymm directory and its day, hour and
+    coverage directories. A file arriving changes its coverage directory's
+    mtime, so this changes whenever the month's files do.
+    """
+    mtime = month_dir.stat().st_mtime
+    for day_dir in _scan_dirs(month_dir.path):
+        mtime = max(mtime, day_dir.stat().st_mtime)
+        for hour_dir in _scan_dirs(day_dir.path):
+            mtime = max(mtime, hour_dir.stat().st_mtime)
+            for coverage_dir in _scan_dirs(hour_dir.path):
+                mtime = max(mtime, coverage_dir.stat().st_mtime)
+
+    return mtime
+
+def get_months(tstart, tend):
+    """
+    The yyyymm months (strings) of the basetimes closest to tstart through
+    tend, for FileInventory.refresh.
+    """
+    month = find_closest_basetime(tstart).replace(day=1, hour=0)
+    month_end = find_closest_basetime(tend)
+
+    months = []
+    while month <= month_end:
+        months.append(month.strftime('%Y%m'))
+        month = (month + delt(days=32)).replace(day=1)
+
+    return months
+
+class FileInventory:
+    """
+    A sorted table of every file under input_dir with its platform, channel,
+    coverage and basetime. Built once with os.scandir and saved to
+    _inventory_path, finding the files for a window is then a binary search.
+    Each row also records its month's _month_mtime when it was scanned so
+    refresh only rescans the months that have changed.
+
+    inventory = get_inventory()
+    inventory.find_files('MTSAT-1R', 'VIS', dt(2010, 7, 30, 21), dt(2010, 7, 31, 3))
+    """
+    columns = ['platform', 'channel', 'coverage', 'basetime', 'path', 'month_mtime']
+
+    def __init__(self, df=None):
+        if df is None:
+            df = pd.DataFrame(columns=FileInventory.columns)
+
+        # Inventories saved before month_mtime was recorded are rescanned in full
+        df = df.assign(basetime=pd.to_datetime(df['basetime']),
+                       month_mtime=df['month_mtime'].astype(np.float64)
+                       if 'month_mtime' in df else np.nan)
+        self.df = df.sort_values(by=FileInventory.columns[:-1]).reset_index(drop=True)
+
+        # (platform, channel, coverage): (sorted basetimes, paths)
+        self._groups = {}
+        for key, group in self.df.groupby(['platform', 'channel', 'coverage']):
+            self._groups[key] = (group['basetime'].to_numpy(dtype='datetime64[s]'),
+                                 group['path'].to_numpy())
+
+    def find_files(self, platform, channel, tstart, tend):
+        """
+        As find_all_files, a dictionary of coverage: [files] for the basetimes
+        closest to tstart through tend.
+        """
+        file_start = np.datetime64(find_closest_basetime(tstart), 's')
+        file_end = np.datetime64(find_closest_basetime(tend), 's')
+
+        files_included = {}
+        for coverage in _coverages:
+            basetimes, paths = self._groups.get((platform, channel, coverage),
+                                                (np.array([], dtype='datetime64[s]'), []))
+
+            i_start = np.searchsorted(basetimes, file_start, side='left')
+            i_end = np.searchsorted(basetimes, file_end, side='right')
+
+            files_included[coverage] = list(paths[i_start:i_end])
+
+        return files_included
+
+    def refresh(self, platforms=_platforms, months=None, full=False):
+        """
+        Rescan the given yyyymm months (strings), or every month if months is
+        None, whose directories have changed since they were scanned, or all
+        of them if full. Returns a new FileInventory, or this one if nothing
+        changed.
+        """
+        df = self.df
+        month_keys = df['platform'] + df['basetime'].dt.strftime('%Y%m')
+        scanned = dict(zip(month_keys, df['month_mtime']))
+
+        rescanned = []
+        new_rows = []
+        for platform in platforms:
+            for month_dir in _scan_dirs(os.path.join(input_dir, platform)):
+                if months is not None and month_dir.name not in months:
+                    continue
+
+                key = platform + month_dir.name
+                mtime = _month_mtime(month_dir)
+                if not full and scanned.get(key) == mtime:
+                    continue
+
+                rows = _scan_month(platform, month_dir)
+                # Months without any files have no rows to record the mtime on
+                if not rows and key not in scanned:
+                    continue
+
+                rescanned.append(key)
+                new_rows += [row + (mtime,) for row in rows]
+
+        if not rescanned:
+            return self
+
+        df = df[~month_keys.isin(rescanned)]
+        new_df = pd.DataFrame(new_rows, columns=FileInventory.columns)
+        return FileInventory(pd.concat([df, new_df], ignore_index=True)
+                             if len(df) else new_df)
+
+    def save(self, path=_inventory_path):
+        # Write to a temp file and rename so other jobs never see a partial inventory
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = '{}.{}.temp'.format(path, os.getpid())
+        self.df.to_csv(temp_path, index=False)
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def load(path=_inventory_path):
+        return FileInventory(pd.read_csv(path, parse_dates=['basetime']))
+
+def get_inventory(path=_inventory_path, refresh=False, months=None, full=False):
+    """
+    Load the saved inventory, building it first if there isn't one. If
+    refresh, or months are given, the changed months (of months) are
+    rescanned as FileInventory.refresh and it's saved again if any were.
+    """
+    if os.path.exists(path):
+        inventory = FileInventory.load(path)
+        if not (refresh or months is not None or full):
+            return inventory
+    else:
+        inventory = FileInventory()
+
+    refreshed = inventory.refresh(months=months, full=full)
+    if refreshed is not inventory or not os.path.exists(path):
+        refreshed.save(path)
+
+    return refreshed
+
+def read_csv_files(infiles):
+    """
+    Read and concatenate the gzipped CSVs into a single data frame with the
+    columns and types in _csv_dtypes.
+    """
+    if pa is not None:
+        read_options = pa_csv.ReadOptions(use_threads=True)
+        convert_options = pa_csv.ConvertOptions(
+            column_types={k: pa.from_numpy_dtype(v) for k, v in _csv_dtypes.items()},
+            include_columns=list(_csv_dtypes))
+
+        tables = []
+        for f in infiles:
+            with input_stream(f, compression='gzip') as stream:
+                tables.append(pa_csv.read_csv(stream,
+                                              read_options=read_options,
+                                              convert_options=convert_options))
+
+        # Concatenate as arrow tables so there's a single conversion to pandas
+        return concat_tables(tables).to_pandas()
+    else:
+        return pd.concat([pd.read_csv(f, compression='gzip',
+                                      usecols=list(_csv_dtypes),
+                                      dtype=_csv_dtypes)
+                          for f in infiles],
+                         ignore_index=True)
+
+def _get_cache_path(directory, channel):
+    return os.path.join(_cache_dir, os.path.relpath(directory, input_dir),
+                        channel + '.npz')
+
+def _get_source_details(infiles):
+    # The key for a cache entry, the path, size and mtime of each source file
+    stats = [os.stat(f) for f in infiles]
+    return (np.array(infiles),
+            np.array([st.st_size for st in stats], dtype=np.int64),
+            np.array([st.st_mtime_ns for st in stats], dtype=np.int64))
+
+def read_csv_files_cached(infiles, cache_path):
+    """
+    As read_csv_files but using the .npz at cache_path if it was made from
+    the same files (path, size and mtime). Otherwise the CSVs are read and
+    the cache is (re)written.
+    """
+    paths, sizes, mtimes = _get_source_details(infiles)
+
+    if os.path.exists(cache_path):
+        try:
+            with np.load(cache_path, allow_pickle=False) as cache:
+                if np.array_equal(cache['paths'], paths) and \
+                        np.array_equal(cache['sizes'], sizes) and \
+                        np.array_equal(cache['mtimes'], mtimes):
+                    return pd.DataFrame({col: cache['c{}'.format(i)]
+                                         for i, col in enumerate(cache['columns'])})
+        except (OSError, ValueError, KeyError) as e:
+            # A corrupt or old format cache, it'll be rewritten
+            print("Ignoring cache {}: {}".format(cache_path, e))
+
+    df = read_csv_files(infiles)
+
+    # Write to a temp file and rename so other jobs never see a partial cache
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp_path = '{}.{}.temp.npz'.format(cache_path[:-len('.npz')], os.getpid())
+        np.savez(temp_path, paths=paths, sizes=sizes, mtimes=mtimes,
+                 columns=np.array(df.columns, dtype=str),
+                 **{'c{}'.format(i): df[col].to_numpy()
+                    for i, col in enumerate(df.columns)})
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        print("Failed to write cache {}: {}".format(cache_path, e))
+
+    return df
+
+def read_wind_files(infiles, channel, use_cache=True):
+    """
+    Read the CSVs for a channel, via the cache for each directory if use_cache.
+    """
+    if not use_cache:
+        return read_csv_files(infiles)
+
+    # Group the files by directory, keeping their order
+    directories = {}
+    for f in infiles:
+        directories.setdefault(os.path.dirname(f), []).append(f)
+
+    dfs = [read_csv_files_cached(files, _get_cache_path(directory, channel))
+           for directory, files in directories.items()]
+
+    return pd.concat(dfs, ignore_index=True) if len(dfs) > 1 else dfs[0]
+
+def get_wind_data(platform, channel, tstart, tend, use_cache=True, inventory=None):
     """
     Return the data frame for the given platform, channel and time window.
     get_wind_data('MTSAT-1R', 'VIS', dt(2010, 7, 30, 21), dt(2010, 7, 31, 3))
     """
-    infiles = find_all_files(platform, channel, tstart, tend)
+    infiles = find_all_files(platform, channel, tstart, tend, inventory)
     data = {}
     for coverage in infiles.keys():
         if len(infiles[coverage]) == 0:
             continue
 
-        df_from_each_file = (pd.read_csv(f, compression='gzip') for f in infiles[coverage])
-        df   = pd.concat(df_from_each_file, ignore_index=True)
+        df = read_wind_files(infiles[coverage], channel, use_cache)
 
         # EDIT by JT: occaasionally the CSVs have no data rows
         if len(df) == 0:
             continue
-        time = num2date(df['time(mjd)'].values, _time_units)
-        time = [dt(t.year, t.month, t.day, t.hour, t.minute, t.second) for t in time]
-        # covnert to datetime objects
-        df['time(mjd)'] = time
-        # truncate df based on time window
-        itime = np.where(np.greater_equal(time, tstart) & np.less_equal(time, tend))[0]
-
-        # EDIT by JT: check itime has elements
-        if len(itime) == 0:
+        # Convert MJD to datetime64, as ms since the MJD epoch
+        time_ms = np.rint(df['time(mjd)'].to_numpy(dtype=np.float64) * _ms_per_day)\
+            .astype(np.int64) + _time_epoch.astype(np.int64)
+
+        # Truncate df based on time window, comparing whole seconds as
+        #  the BUFR only holds seconds
+        time_s = time_ms // 1000
+        in_window = (time_s >= _datetime_to_seconds(tstart)) & \
+            (time_s <= _datetime_to_seconds(tend))
+
+        # EDIT by JT: check there's data in the window
+        if not in_window.any():
             continue
 
-        if itime[0] > 0:
-            df = df.truncate(before=itime[0])
-        if itime[-1] < len(time)-1:
-            df = df.truncate(after=itime[-1])
-        
+        df = df[in_window].reset_index(drop=True)
+        # convert to datetimes
+        df['time(mjd)'] = time_ms[in_window].astype('datetime64[ms]')
+
         data[coverage] = df
 
     return data
 
+def print_hemispheres(inventory, platforms=['MTSAT-1R', 'MTSAT-2']):
+    """
+    Print the coverages present for each basetime, as missing_hemispheres.sh
+    """
+    df = inventory.df[inventory.df['platform'].isin(platforms)]
+    df = df[['platform', 'basetime', 'coverage']].drop_duplicates() \
+        .sort_values(by=['platform', 'basetime', 'coverage'])
+
+    print("SatelliteName,Datetime,Hemisphere")
+    for platform, basetime, coverage in df.itertuples(index=False):
+        print("{},{:%Y%m%dT%H00Z},{}".format(platform, basetime,
+                                              'n' if coverage == 'f' else coverage))
+
+def benchmark_read_csv(platform, channel, month, inventory=None):
+    """
+    Compare read_csv_files with the untyped pd.read_csv for a month of files.
+    benchmark_read_csv('MTSAT-2', 'IR1', dt(2011, 1, 1))
+    """
+    tend = (month + delt(days=32)).replace(day=1) - delt(hours=6)
+    infiles = find_all_files(platform, channel, month, tend, inventory)
+    infiles = [f for coverage in infiles for f in infiles[coverage]]
+    print("{} files for {} {} {:%Y%m}".format(len(infiles), platform, channel, month))
+
+    t = time()
+    df_untyped = pd.concat((pd.read_csv(f, compression='gzip') for f in infiles),
+                           ignore_index=True)
+    print("Untyped pd.read_csv: {:.2f} s, {} rows, {:.1f} MB".format(
+        time() - t, len(df_untyped), df_untyped.memory_usage().sum() / 1e6))
+
+    t = time()
+    df_typed = read_csv_files(infiles)
+    print("read_csv_files ({}): {:.2f} s, {} rows, {:.1f} MB".format(
+        "pyarrow" if pa is not None else "pandas", time() - t, len(df_typed),
+        df_typed.memory_usage().sum() / 1e6))
 
+if __name__ == "__main__":
+    # python3 jma_interface.py inventory [--full] [yyyymm ...]
+    #   Build or refresh the inventory, rescanning the changed months (of
+    #   those given) or with --full every month
+    # python3 jma_interface.py hemispheres
+    #   Print the MTSAT coverages for each basetime, refreshing the inventory
+    # python3 jma_interface.py benchmark MTSAT-2 IR1 201101
+    #   Time reading a month of CSVs
+    if sys.argv[1] == 'inventory':
+        full = '--full' in sys.argv[2:]
+        months = [m for m in sys.argv[2:] if m != '--full']
+        inventory = get_inventory(refresh=True, months=months if months else None,
+                                  full=full)
+        print("{} files in {}".format(len(inventory.df), _inventory_path))
+    elif sys.argv[1] == 'hemispheres':
+        print_hemispheres(get_inventory(refresh=True))
+    elif sys.argv[1] == 'benchmark':
+        benchmark_read_csv(sys.argv[2], sys.argv[3], dt.strptime(sys.argv[4], '%Y%m'),
+                           get_inventory())
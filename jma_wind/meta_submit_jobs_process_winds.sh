@@ -13,10 +13,16 @@ let BIN_OFFSET_SEC=$BIN_SIZE_SEC/2
 # Job script
 SCRIPT=/g/data/hd50/jt4085/BARRA2/jma_wind/submit_job_process_winds.sh
 
+# Builds/refreshes the inventory of input files shared by the jobs
+INTERFACE_SCRIPT=/g/data/hd50/jt4085/BARRA2/jma_wind/jma_interface.py
+
 # Number of jobs to submit
 N_JOBS=100
 
 ## SCRIPT
+# Refresh the inventory once here rather than in every job
+python3 $INTERFACE_SCRIPT inventory
+
 # Convert the datetime strings to timestamps
 start_timestamp=`date --date=$START_DATETIME_STR '+%s'`
 end_timestamp=`date --date=$END_DATETIME_STR '+%s'`
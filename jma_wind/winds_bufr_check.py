@@ -18,7 +18,7 @@ from pandas import concat
 # Import custom modules
 path.insert(1, "/g/data/hd50/jt4085/BARRA2/util/bufr")
 from eccodes_wrapper import BufrFile
-from jma_interface import get_wind_data
+from jma_interface import get_wind_data, get_inventory
 
 # Silence matplotlib warning related to cartopy
 from warnings import filterwarnings
@@ -180,10 +180,13 @@ def main1():
         CHANNEL_NAMES = ["VIS", "IR1", "IR2", "IR3", "IR4"]
         CHANNEL_NAMES = ["VIS", "IR1", "IR3"]
 
+        inventory = get_inventory()
+
         raw_data = None
         for sat in SATELLITE_NAMES:
             for chan in CHANNEL_NAMES:
-                raw = get_wind_data(sat, chan, start_dt, end_dt)
+                raw = get_wind_data(sat, chan, start_dt, end_dt,
+                                    inventory=inventory)
 
                 if raw is None:
                     continue
@@ -10,12 +10,21 @@
 # IMPORTS
 from argparse import ArgumentParser, ArgumentTypeError
 from math import floor, sqrt
-from numpy import sqrt, arctan2, degrees
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+from numpy import sqrt, arctan2, degrees, arange, concatenate, nonzero, \
+    lexsort, searchsorted, int64, float64, full
+from multiprocessing import get_context
+from os import makedirs, remove, replace, environ
+from os.path import exists, getsize, dirname, join
+from sys import exit
+from time import time
 from scipy.constants import c
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 import eccodes as ecc
 
-from jma_interface import get_wind_data
+from jma_interface import get_wind_data, get_inventory, get_months
 
 # PARAMETERS
 # Commandline arg datetime format
@@ -27,6 +36,31 @@ SAMPLE_TEMPLATE = "BUFR3_local_satellite"
 # Length to separate the data into
 BUFR_MESSAGE_LEN = 550
 
+# Message sizing, see MessageSizing
+# Per product (satellite, channel) overrides of the number of subsets or a
+#  target message size in bytes, e.g. {("MTSAT-2", "IR1"): {"bytes": 200000}}
+PRODUCT_MESSAGE_SIZES = {}
+# Bounds on the subsets per message, numberOfSubsets is 16 bits
+MIN_MESSAGE_SUBSETS = 1
+MAX_MESSAGE_SUBSETS = 65535
+# When grouping rows, rows are ordered by time in buckets of this many
+#  seconds and then by pressure
+GROUP_TIME_SECONDS = 600
+
+# Range mode
+# Default size of the bins, they're centred on multiples of the bin size
+#  i.e. for 6 hours 21Z-3Z, 3Z-9Z, 9Z-15Z and 15Z-21Z
+BIN_HOURS = 6
+# Number of bins to read the CSVs for at once
+RANGE_BLOCK_BINS = 28
+# Bins are written to <output dir>/<YYYY>/<MM>/<centre>/<centre>.bufr
+OUTPUT_DT_FORMAT = "%Y%m%dT%H%M"
+TEMP_EXTENSION = ".temp"
+
+# Multiprocessing, the number of processes is taken from PBS_NCPUS
+#  otherwise N_CPU
+N_CPU = 1
+
 # Bufr Sequence
 UNEXPANDED_DESCRIPTORS = [
     310014, 222000, 236000, 101103,  31031,
@@ -57,6 +91,18 @@ DATA_PRESENT_BITMAP = [
     1, 1, 1
 ]
 
+# Quality info that's always zero, set once in the message templates
+NOMINAL_CONFIDENCE_THRESHOLD_KEYS = [
+    '#1#{}->nominalConfidenceThreshold'.format(var) + '->nominalConfidenceThreshold' * i
+    for var in ['pressure', 'windSpeed', 'windDirection'] for i in range(3)
+]
+
+# Maximum number of prepared message templates to keep,
+#  keyed on (satellite, channel, number of subsets). Templates are only made
+#  for full size messages, each product's shorter last message is built
+#  directly.
+MAX_TEMPLATES = 16
+
 # Satellites
 #  https://confluence.ecmwf.int/display/ECC/WMO%3D2+code-flag+table#WMO=2codeflagtable-CF_001007
 #  centre is the central wavelength in microns, bandwidth is also in microns
@@ -98,140 +144,478 @@ SATELLITES = {"GMS-5": {
               }
 
 
+# The prepared messages, see get_template
+_templates = OrderedDict()
+
+
 # METHODS
+def create_message(satellite_name, channel_name, d_len):
+    """
+    Create a message with everything but the data's varying values set for
+    d_len subsets of the satellite and channel's data.
+    """
+    # Create the bufr message from the sample.
+    output_bufr = ecc.codes_bufr_new_from_samples(SAMPLE_TEMPLATE)
+
+    # Set the data present bitmap for the quality info
+    ecc.codes_set_long_array(output_bufr, 'inputDataPresentIndicator',
+                             DATA_PRESENT_BITMAP)
+
+    # Set header values
+    # These are set to be the same as in the template
+    ecc.codes_set(output_bufr, 'edition', 3)
+    ecc.codes_set(output_bufr, 'masterTableNumber', 0)
+    ecc.codes_set(output_bufr, 'bufrHeaderCentre', 34)
+    ecc.codes_set(output_bufr, 'bufrHeaderSubCentre', 0)
+    ecc.codes_set(output_bufr, 'dataCategory', 5)
+    ecc.codes_set(output_bufr, 'dataSubCategory', 87)
+    ecc.codes_set(output_bufr, 'masterTablesVersionNumber', 8)
+    ecc.codes_set(output_bufr, 'localTablesVersionNumber', 0)
+
+    # Data set details
+    ecc.codes_set(output_bufr, 'numberOfSubsets', d_len)
+    ecc.codes_set(output_bufr, 'localNumberOfObservations', d_len)
+    ecc.codes_set(output_bufr, 'observedData', 1)
+    ecc.codes_set(output_bufr, 'compressedData', 1)
+
+    # BUFR Sequence
+    ecc.codes_set_long_array(output_bufr, 'unexpandedDescriptors',
+                             UNEXPANDED_DESCRIPTORS)
+
+    # Satellite details
+    sat_id = SATELLITES[satellite_name]["id"]
+    # Central wavelength (wl) and frequency (fq)
+    sat_centre_wl = SATELLITES[satellite_name][channel_name]["centre"] * 1e-6
+    sat_centre_fq = c / sat_centre_wl
+
+    # Bandwidth in wavelength (wl) and frequency (fq)
+    sat_bandwidth_wl = SATELLITES[satellite_name][channel_name]["bandwidth"] * 1e-6
+    sat_bandwidth_fq = c / (sat_centre_wl - 0.5 * sat_bandwidth_wl) - \
+                       c / (sat_centre_wl + 0.5 * sat_bandwidth_wl)
+
+    ecc.codes_set(output_bufr, 'satelliteID',
+                  sat_id)
+    ecc.codes_set_array(output_bufr, 'satelliteIdentifier',
+                        full(d_len, sat_id))
+    ecc.codes_set_array(output_bufr, 'satelliteChannelCentreFrequency',
+                        full(d_len, sat_centre_fq))
+    ecc.codes_set_array(output_bufr, 'satelliteChannelBandWidth',
+                        full(d_len, sat_bandwidth_fq))
+
+    # Computation method seems to depend on channel
+    # Options here - https://confluence.ecmwf.int/display/ECC/WMO%3D14+code-flag+table#WMO=14codeflagtable-CF_002023
+    # Apparently this should be 3?
+    computationMethod = 3
+    ecc.codes_set_array(output_bufr,
+                        'satelliteDerivedWindComputationMethod',
+                        full(d_len, computationMethod))
+
+    # Originating Centre - JMA - 34
+    # Turns out this needs to be set for every subset.
+    ecc.codes_set_array(output_bufr, '#1#centre', full(d_len, 34))
+
+    # The nominal confidence thresholds are all zero
+    zeros = full(d_len, 0)
+    for key in NOMINAL_CONFIDENCE_THRESHOLD_KEYS:
+        ecc.codes_set_array(output_bufr, key, zeros)
+
+    return output_bufr
+
+
+def create_template(satellite_name, channel_name, d_len):
+    # A packed create_message to clone
+    output_bufr = create_message(satellite_name, channel_name, d_len)
+    ecc.codes_set(output_bufr, 'pack', 1)
+
+    return output_bufr
+
+
+def get_template(satellite_name, channel_name, d_len):
+    """
+    Return the prepared message from create_template, at most MAX_TEMPLATES
+    are kept (least recently used are released first).
+    """
+    key = (satellite_name, channel_name, d_len)
+
+    template = _templates.get(key)
+    if template is not None:
+        _templates.move_to_end(key)
+        return template
+
+    if len(_templates) >= MAX_TEMPLATES:
+        _, oldest = _templates.popitem(last=False)
+        ecc.codes_release(oldest)
+
+    template = create_template(satellite_name, channel_name, d_len)
+    _templates[key] = template
+
+    return template
+
+
+def encode_chunk(arrays, satellite_name, channel_name, subsets=None):
+    """
+    Encode a chunk of the data as a BUFR message and return its bytes.
+    arrays is a slice of prepare_arrays.
+
+    If the chunk is a full message of subsets rows it's copied from a
+    template (see get_template), otherwise, e.g. the last chunk of a
+    product or if subsets isn't given, the message is built directly.
+    """
+    d_len = len(arrays['longitude'])
+
+    if d_len == subsets:
+        # Copy the prepared message, only the varying values need setting
+        output_bufr = ecc.codes_clone(get_template(satellite_name, channel_name, d_len))
+        ecc.codes_set(output_bufr, 'unpack', 1)
+    else:
+        output_bufr = create_message(satellite_name, channel_name, d_len)
+
+    # Set time values
+    # For now set them to the fist time in the data set.
+    first_year = int(arrays['#1#year'][0])
+    ecc.codes_set(output_bufr, 'typicalCentury', floor(first_year / 100))
+    ecc.codes_set(output_bufr, 'typicalYearOfCentury', first_year % 100)
+    ecc.codes_set(output_bufr, 'typicalMonth', int(arrays['#1#month'][0]))
+    ecc.codes_set(output_bufr, 'typicalDay', int(arrays['#1#day'][0]))
+    ecc.codes_set(output_bufr, 'typicalHour', int(arrays['#1#hour'][0]))
+    ecc.codes_set(output_bufr, 'typicalMinute', int(arrays['#1#minute'][0]))
+
+    # Set the data arrays
+    for key, values in arrays.items():
+        if values.dtype.kind == 'f':
+            ecc.codes_set_double_array(output_bufr, key, values)
+        else:
+            ecc.codes_set_long_array(output_bufr, key, values)
+
+    # Finish the file
+    ecc.codes_set(output_bufr, 'pack', 1)
+
+    message = ecc.codes_get_message(output_bufr)
+
+    ecc.codes_release(output_bufr)
+
+    return message
+
+
+def slice_arrays(arrays, i, subsets=BUFR_MESSAGE_LEN):
+    # The chunk of the prepared arrays from row i, as views
+    return {key: values[i:i + subsets] for key, values in arrays.items()}
+
+
+def get_chunks(prepared, subsets=BUFR_MESSAGE_LEN):
+    """
+    Return (key, start row) for each message's chunk of the prepared data,
+    in the order they're written.
+    """
+    # Potentially multiple datasets per data
+    # They'll be written as serial messages
+    # a - full dish, f - Northern hemisphere, s - Southern hemisphere
+    return [(key, i) for key in prepared
+            for i in range(0, len(prepared[key]['longitude']), subsets)]
+
+
+class MessageSizing:
+    """
+    How a product's rows are split into messages.
+
+    Either a fixed number of subsets per message or, with target_bytes, the
+    number of subsets estimated to give messages of about that size from
+    encoding a sample of the product. PRODUCT_MESSAGE_SIZES overrides either
+    per product unless product_sizes is False, as when benchmarking.
+
+    If group, the rows are ordered by time (in GROUP_TIME_SECONDS buckets)
+    and then pressure so each message holds similar values, keeping the
+    compressed increments small.
+
+    The defaults are the fixed BUFR_MESSAGE_LEN in the data's order.
+    """
+
+    def __init__(self, subsets=BUFR_MESSAGE_LEN, target_bytes=None, group=False,
+                 product_sizes=True):
+        self.subsets = subsets
+        self.target_bytes = target_bytes
+        self.group = group
+        self.product_sizes = product_sizes
+
+    def __str__(self):
+        if self.target_bytes:
+            size = "{} bytes".format(self.target_bytes)
+        else:
+            size = "{} subsets".format(self.subsets)
+
+        return size + (", grouped" if self.group else "")
+
+    def prepare(self, arrays):
+        """
+        Return the arrays, reordered if grouping.
+        """
+        if not self.group:
+            return arrays
+
+        time_bucket = (arrays['#1#day'] * 86400 + arrays['#1#hour'] * 3600 +
+                       arrays['#1#minute'] * 60 + arrays['#1#second']) // GROUP_TIME_SECONDS
+        order = lexsort((arrays['#1#pressure'], time_bucket,
+                         arrays['#1#month'], arrays['#1#year']))
+
+        return {key: values[order] for key, values in arrays.items()}
+
+    def get_subsets(self, prepared, satellite_name, channel_name):
+        """
+        Return the number of subsets per message for the product's prepared
+        data (coverage: arrays).
+        """
+        product_size = PRODUCT_MESSAGE_SIZES.get((satellite_name, channel_name), {}) \
+            if self.product_sizes else {}
+        subsets = product_size.get("subsets", self.subsets)
+        target_bytes = product_size.get("bytes", self.target_bytes)
+
+        if target_bytes:
+            subsets = self._estimate_subsets(prepared, satellite_name,
+                                             channel_name, target_bytes, subsets)
+
+        return min(max(subsets, MIN_MESSAGE_SUBSETS), MAX_MESSAGE_SUBSETS)
+
+    @staticmethod
+    def _estimate_subsets(prepared, satellite_name, channel_name,
+                          target_bytes, sample_subsets):
+        # Encode the first sample_subsets rows of the largest coverage and
+        #  half as many to estimate the fixed and per subset bytes
+        arrays = max(prepared.values(), key=lambda a: len(a['longitude']))
+        n = min(sample_subsets, len(arrays['longitude']))
+
+        if n < 2:
+            return sample_subsets
+
+        n_half = n // 2
+        size = len(encode_chunk(slice_arrays(arrays, 0, n),
+                                satellite_name, channel_name, sample_subsets))
+        size_half = len(encode_chunk(slice_arrays(arrays, 0, n_half),
+                                     satellite_name, channel_name))
+
+        per_subset = max((size - size_half) / (n - n_half), 1e-3)
+        fixed = max(size - per_subset * n, 0)
+
+        return int((target_bytes - fixed) // per_subset)
+
+
 def data_to_bufr(data, output_file,
-                 satellite_name, channel_name):
-    for key in data:
-        # Potentially multiple datasets per data
-        # They'll be written as serial messages
-        # a - full dish, f - Northern hemisphere, s - Southern hemisphere
-        full_dataframe = data[key]
-
-        for i in range(0, len(full_dataframe), BUFR_MESSAGE_LEN):
-            # Grab the next chunk of the data
-            dataframe = full_dataframe[i:i + BUFR_MESSAGE_LEN]
-            d_len = len(dataframe)
-
-            # Create the bufr message from the sample.
-            output_bufr = ecc.codes_bufr_new_from_samples(SAMPLE_TEMPLATE)
-
-            # Set the data present bitmap for the quality info
-            ecc.codes_set_long_array(output_bufr, 'inputDataPresentIndicator',
-                                     DATA_PRESENT_BITMAP)
-
-            # Set header values
-            # These are set to be the same as in the template
-            ecc.codes_set(output_bufr, 'edition', 3)
-            ecc.codes_set(output_bufr, 'masterTableNumber', 0)
-            ecc.codes_set(output_bufr, 'bufrHeaderCentre', 34)
-            ecc.codes_set(output_bufr, 'bufrHeaderSubCentre', 0)
-            ecc.codes_set(output_bufr, 'dataCategory', 5)
-            ecc.codes_set(output_bufr, 'dataSubCategory', 87)
-            ecc.codes_set(output_bufr, 'masterTablesVersionNumber', 8)
-            ecc.codes_set(output_bufr, 'localTablesVersionNumber', 0)
-
-            # Data set details
-            ecc.codes_set(output_bufr, 'numberOfSubsets', d_len)
-            ecc.codes_set(output_bufr, 'localNumberOfObservations', d_len)
-            ecc.codes_set(output_bufr, 'observedData', 1)
-            ecc.codes_set(output_bufr, 'compressedData', 1)
-
-            # Set time values
-            # For now set them to the fist time in the data set.
-            first_dt = dataframe['time(mjd)'].iloc[0]
-            ecc.codes_set(output_bufr, 'typicalCentury', floor(first_dt.year / 100))
-            ecc.codes_set(output_bufr, 'typicalYearOfCentury', first_dt.year % 100)
-            ecc.codes_set(output_bufr, 'typicalMonth', first_dt.month)
-            ecc.codes_set(output_bufr, 'typicalDay', first_dt.day)
-            ecc.codes_set(output_bufr, 'typicalHour', first_dt.hour)
-            ecc.codes_set(output_bufr, 'typicalMinute', first_dt.minute)
-
-            # BUFR Sequence
-            ecc.codes_set_long_array(output_bufr, 'unexpandedDescriptors',
-                                     UNEXPANDED_DESCRIPTORS)
-
-            # Satellite details
-            sat_id = SATELLITES[satellite_name]["id"]
-            # Central wavelength (wl) and frequency (fq)
-            sat_centre_wl = SATELLITES[satellite_name][channel_name]["centre"] * 1e-6
-            sat_centre_fq = c / sat_centre_wl
-
-            # Bandwidth in wavelength (wl) and frequency (fq)
-            sat_bandwidth_wl = SATELLITES[satellite_name][channel_name]["bandwidth"] * 1e-6
-            sat_bandwidth_fq = c / (sat_centre_wl - 0.5 * sat_bandwidth_wl) - \
-                               c / (sat_centre_wl + 0.5 * sat_bandwidth_wl)
-
-            ecc.codes_set(output_bufr, 'satelliteID',
-                          sat_id)
-            ecc.codes_set_array(output_bufr, 'satelliteIdentifier',
-                                [sat_id]*d_len)
-            ecc.codes_set_array(output_bufr, 'satelliteChannelCentreFrequency',
-                                [sat_centre_fq]*d_len)
-            ecc.codes_set_array(output_bufr, 'satelliteChannelBandWidth',
-                                [sat_bandwidth_fq]*d_len)
-
-            # Computation method seems to depend on channel
-            # Options here - https://confluence.ecmwf.int/display/ECC/WMO%3D14+code-flag+table#WMO=14codeflagtable-CF_002023
-            # Apparently this should be 3?
-            computationMethod = 3
-            ecc.codes_set_array(output_bufr,
-                                'satelliteDerivedWindComputationMethod',
-                                [computationMethod]*d_len)
-
-            # Originating Centre - JMA - 34
-            # Turns out this needs to be set for every subset.
-            ecc.codes_set_array(output_bufr, '#1#centre', [34]*d_len)
-
-            # Set the data arrays
-            set_arrays_for_dataframe(dataframe, output_bufr)
-
-            # Finish the file
-            ecc.codes_set(output_bufr, 'pack', 1)
-
-            ecc.codes_write(output_bufr, output_file)
-
-            ecc.codes_release(output_bufr)
-
-
-def set_arrays_for_dataframe(dataframe, output_bufr):
+                 satellite_name, channel_name, sizing=None):
+    sizing = sizing if sizing else MessageSizing()
+
+    prepared = {key: sizing.prepare(prepare_arrays(data[key])) for key in data}
+    subsets = sizing.get_subsets(prepared, satellite_name, channel_name)
+
+    for key, i in get_chunks(prepared, subsets):
+        # Grab the next chunk of the data
+        output_file.write(encode_chunk(slice_arrays(prepared[key], i, subsets),
+                                       satellite_name, channel_name, subsets))
+
+
+# The data being encoded by a shared_pool, the workers are forked after it's
+#  set so they share it read-only rather than having it pickled to them
+_shared_data = []
+
+
+def prepare_data_list(data_list, sizing):
+    """
+    Prepare each (satellite name, channel name, data) in data_list for
+    encoding. Returns a list of (satellite name, channel name, prepared
+    arrays per coverage, subsets per message).
+    """
+    prepared_list = []
+    for satellite_name, channel_name, data in data_list:
+        prepared = {key: sizing.prepare(prepare_arrays(data[key])) for key in data}
+        subsets = sizing.get_subsets(prepared, satellite_name, channel_name)
+        prepared_list.append((satellite_name, channel_name, prepared, subsets))
+
+    return prepared_list
+
+
+def get_tasks(prepared_list, offset=0):
+    """
+    Return the _encode_shared_chunk tasks for prepared_list, in the order
+    they're written. offset is prepared_list's position in _shared_data.
+    """
+    return [(offset + j, key, i, subsets)
+            for j, (_, _, prepared, subsets) in enumerate(prepared_list)
+            for key, i in get_chunks(prepared, subsets)]
+
+
+def _encode_shared_chunk(task):
+    # task is (index into _shared_data, key, start row, subsets)
+    j, key, i, subsets = task
+    satellite_name, channel_name, prepared, _ = _shared_data[j]
+
+    return encode_chunk(slice_arrays(prepared[key], i, subsets),
+                        satellite_name, channel_name, subsets)
+
+
+@contextmanager
+def shared_pool(shared_data, n_processes):
+    """
+    A pool of n_processes forked with _shared_data set to shared_data, for
+    write_tasks. The workers' templates last as long as the pool, so use
+    one pool for as much data as possible.
+    """
+    global _shared_data
+
+    _shared_data = shared_data
+    try:
+        with get_context("fork").Pool(n_processes) as pool:
+            yield pool
+    finally:
+        _shared_data = []
+
+
+def write_tasks(pool, tasks, output_file):
+    # Encode the chunks in parallel, writing them in order
+    for message in pool.imap(_encode_shared_chunk, tasks, chunksize=4):
+        output_file.write(message)
+
+
+def write_bufr(data_list, output_file, n_processes=N_CPU, sizing=None):
+    """
+    Write the data for each (satellite name, channel name, data) in data_list
+    to output_file. With more than one process the chunks are encoded in
+    parallel and written in the same order as data_to_bufr, so the output
+    is identical.
+    """
+    sizing = sizing if sizing else MessageSizing()
+
+    if n_processes <= 1:
+        for satellite_name, channel_name, data in data_list:
+            data_to_bufr(data, output_file, satellite_name, channel_name, sizing)
+        return
+
+    prepared_list = prepare_data_list(data_list, sizing)
+    tasks = get_tasks(prepared_list)
+
+    if len(tasks) == 0:
+        return
+
+    with shared_pool(prepared_list, min(n_processes, len(tasks))) as pool:
+        write_tasks(pool, tasks, output_file)
+
+
+def write_output(output_path, write):
+    """
+    Call write with a temp file then move it to output_path, unless nothing
+    was written.
+    """
+    temp_output_path = output_path + TEMP_EXTENSION
+
+    makedirs(dirname(output_path), exist_ok=True)
+    with open(temp_output_path, 'wb') as f:
+        write(f)
+
+    # Move the temp file to the output file if it exists and is >0
+    if getsize(temp_output_path) > 0:
+        replace(temp_output_path, output_path)
+    else:
+        # Delete the temp file is the size is zero
+        remove(temp_output_path)
+
+
+def benchmark_sizing(data_list, sizings):
+    """
+    Encode and decode data_list with each MessageSizing, printing the
+    encode time, output size and decode time.
+    """
+    print("{:>24} {:>9} {:>12} {:>10} {:>10}".format(
+        "Sizing", "Messages", "Bytes", "Encode s", "Decode s"))
+
+    for sizing in sizings:
+        t = time()
+        messages = []
+        for satellite_name, channel_name, data in data_list:
+            prepared = {key: sizing.prepare(prepare_arrays(data[key])) for key in data}
+            subsets = sizing.get_subsets(prepared, satellite_name, channel_name)
+            messages += [encode_chunk(slice_arrays(prepared[key], i, subsets),
+                                      satellite_name, channel_name, subsets)
+                         for key, i in get_chunks(prepared, subsets)]
+        encode_time = time() - t
+
+        t = time()
+        for message in messages:
+            msg_id = ecc.codes_new_from_message(message)
+            ecc.codes_set(msg_id, 'unpack', 1)
+            ecc.codes_release(msg_id)
+        decode_time = time() - t
+
+        print("{:>24} {:>9} {:>12} {:>10.2f} {:>10.2f}".format(
+            str(sizing), len(messages), sum(len(m) for m in messages),
+            encode_time, decode_time))
+
+
+def verify_templates(data_list, sizing=None):
+    """
+    Encode every chunk of data_list both from a template and directly,
+    printing any chunks whose bytes differ. Returns the number that differ.
+    """
+    sizing = sizing if sizing else MessageSizing()
+
+    n_chunks = 0
+    n_different = 0
+    for satellite_name, channel_name, prepared, subsets in \
+            prepare_data_list(data_list, sizing):
+        for key, i in get_chunks(prepared, subsets):
+            chunk = slice_arrays(prepared[key], i, subsets)
+            d_len = len(chunk['longitude'])
+
+            from_template = encode_chunk(chunk, satellite_name, channel_name, d_len)
+            direct = encode_chunk(chunk, satellite_name, channel_name)
+
+            n_chunks += 1
+            if from_template != direct:
+                n_different += 1
+                print("{} {} {} rows {}-{}: {} bytes from the template, {} "
+                      "built directly".format(satellite_name, channel_name, key,
+                                              i, i + d_len, len(from_template),
+                                              len(direct)))
+
+    print("{} of {} messages differ".format(n_different, n_chunks))
+
+    return n_different
+
+
+def prepare_arrays(dataframe):
+    """
+    Compute the values to encode for every row of the dataframe at once.
+    Returns a dictionary of BUFR key: numpy array, float64 for the values
+    set as doubles and int64 for those set as longs.
+    """
+    arrays = {}
+
     # Longitude & Latitude
-    ecc.codes_set_array(output_bufr, 'longitude',
-                        dataframe['lon(deg.)'].to_numpy())
-    ecc.codes_set_array(output_bufr, 'latitude',
-                        dataframe['lat(deg.)'].to_numpy())
+    arrays['longitude'] = dataframe['lon(deg.)'].to_numpy(dtype=float64)
+    arrays['latitude'] = dataframe['lat(deg.)'].to_numpy(dtype=float64)
 
     # Height/Pressure
     # 1 Pa = 100 hPa
-    ecc.codes_set_array(output_bufr, '#1#pressure',
-                        (dataframe['height(hPa)'] * 100).to_numpy())
-
-    # Time
-    ecc.codes_set_array(output_bufr, '#1#year',
-                        [int(i) for i in dataframe['time(mjd)'].dt.year])
-    ecc.codes_set_array(output_bufr, '#1#month',
-                        [int(i) for i in dataframe['time(mjd)'].dt.month])
-    ecc.codes_set_array(output_bufr, '#1#day',
-                        [int(i) for i in dataframe['time(mjd)'].dt.day])
-    ecc.codes_set_array(output_bufr, '#1#hour',
-                        [int(i) for i in dataframe['time(mjd)'].dt.hour])
-    ecc.codes_set_array(output_bufr, '#1#minute',
-                        [int(i) for i in dataframe['time(mjd)'].dt.minute])
-    ecc.codes_set_array(output_bufr, '#1#second',
-                        [int(i) for i in dataframe['time(mjd)'].dt.second])
+    arrays['#1#pressure'] = dataframe['height(hPa)'].to_numpy(dtype=float64) * 100
+
+    # Time, truncated to whole seconds
+    times = dataframe['time(mjd)'].to_numpy().astype('datetime64[ms]')
+    years = times.astype('datetime64[Y]')
+    months = times.astype('datetime64[M]')
+    days = times.astype('datetime64[D]')
+    seconds_of_day = (times - days).astype('timedelta64[s]').astype(int64)
+
+    arrays['#1#year'] = years.astype(int64) + 1970
+    arrays['#1#month'] = (months - years).astype(int64) + 1
+    arrays['#1#day'] = (days - months).astype(int64) + 1
+    arrays['#1#hour'] = seconds_of_day // 3600
+    arrays['#1#minute'] = seconds_of_day // 60 % 60
+    arrays['#1#second'] = seconds_of_day % 60
 
     # Wind speed and velocity
-    u = dataframe['u (m/s)']
-    v = dataframe['v (m/s)']
+    u = dataframe['u (m/s)'].to_numpy(dtype=float64)
+    v = dataframe['v (m/s)'].to_numpy(dtype=float64)
 
     # Wind direction is a bit odd in the meteorological context.
     # More info: http://colaweb.gmu.edu/dev/clim301/lectures/wind/wind-uv
-    wind_speed = sqrt(u ** 2 + v ** 2)
-    wind_direction = (270 - degrees(arctan2(v, u))) % 360
-
-    ecc.codes_set_array(output_bufr, '#1#windSpeed',
-                        wind_speed.to_numpy())
-    ecc.codes_set_array(output_bufr, '#1#windDirection',
-                        wind_direction.to_numpy())
+    arrays['#1#windSpeed'] = sqrt(u ** 2 + v ** 2)
+    arrays['#1#windDirection'] = (270 - degrees(arctan2(v, u))) % 360
 
     # Quality Index
     # QI*100 = percent confidence
@@ -239,70 +623,190 @@ def set_arrays_for_dataframe(dataframe, output_bufr):
     #           Do the u & v errors need combined for windSpeed/Dir?
     # TODO: What does the QI apply to?
     #           Measurement (u & v)? Coordinates (lat, lon, pres)?
-    ecc.codes_set_array(output_bufr, '#1#windSpeed->percentConfidence',
-                        (100 * dataframe['QI using NWP']).to_numpy())
-    ecc.codes_set_array(output_bufr, '#1#windDirection->percentConfidence',
-                        (100 * dataframe['QI using NWP']).to_numpy())
+    qi_nwp = 100 * dataframe['QI using NWP'].to_numpy(dtype=float64)
+    qi_no_nwp = 100 * dataframe['QI not using NWP'].to_numpy(dtype=float64)
+
+    arrays['#1#windSpeed->percentConfidence'] = qi_nwp
+    arrays['#1#windDirection->percentConfidence'] = qi_nwp
 
     # Setting more quality info to try to get things working
     # TODO: Figure this out and do it properly
-    ecc.codes_set_array(output_bufr,
-        '#1#pressure->percentConfidence',
-        (100 * dataframe['QI using NWP']).to_numpy())
-    ecc.codes_set_array(output_bufr,
-        '#1#pressure->percentConfidence->percentConfidence',
-        (100 * dataframe['QI not using NWP']).to_numpy())
-    ecc.codes_set_array(output_bufr,
-        '#1#pressure->percentConfidence->percentConfidence->percentConfidence',
-        (100 * dataframe['QI not using NWP']).to_numpy())
+    arrays['#1#pressure->percentConfidence'] = qi_nwp
+    arrays['#1#pressure->percentConfidence->percentConfidence'] = qi_no_nwp
+    arrays['#1#pressure->percentConfidence->percentConfidence->percentConfidence'] = qi_no_nwp
 
-    ecc.codes_set_array(output_bufr,
-        '#1#pressure->nominalConfidenceThreshold',
-        [0]*len(dataframe))
-    ecc.codes_set_array(output_bufr,
-        '#1#pressure->nominalConfidenceThreshold->nominalConfidenceThreshold',
-        [0]*len(dataframe))
-    ecc.codes_set_array(output_bufr,
-        '#1#pressure->nominalConfidenceThreshold->nominalConfidenceThreshold->nominalConfidenceThreshold',
-        [0]*len(dataframe))
+    arrays['#1#windSpeed->percentConfidence->percentConfidence'] = qi_no_nwp
+    arrays['#1#windSpeed->percentConfidence->percentConfidence->percentConfidence'] = qi_no_nwp
 
-    ecc.codes_set_array(output_bufr,
-        '#1#windSpeed->percentConfidence->percentConfidence',
-        (100 * dataframe['QI not using NWP']).to_numpy())
-    ecc.codes_set_array(output_bufr,
-        '#1#windSpeed->percentConfidence->percentConfidence->percentConfidence',
-        (100 * dataframe['QI not using NWP']).to_numpy())
+    arrays['#1#windDirection->percentConfidence->percentConfidence'] = qi_no_nwp
+    arrays['#1#windDirection->percentConfidence->percentConfidence->percentConfidence'] = qi_no_nwp
 
-    ecc.codes_set_array(output_bufr,
-        '#1#windSpeed->nominalConfidenceThreshold',
-        [0]*len(dataframe))
-    ecc.codes_set_array(output_bufr,
-        '#1#windSpeed->nominalConfidenceThreshold->nominalConfidenceThreshold',
-        [0]*len(dataframe))
-    ecc.codes_set_array(output_bufr,
-        '#1#windSpeed->nominalConfidenceThreshold->nominalConfidenceThreshold->nominalConfidenceThreshold',
-        [0]*len(dataframe))
+    # Satellite Zenith Angle
+    arrays['satelliteZenithAngle'] = dataframe['satzenithangle(deg.)'].to_numpy(dtype=float64)
 
-    ecc.codes_set_array(output_bufr,
-        '#1#windDirection->percentConfidence->percentConfidence',
-        (100 * dataframe['QI not using NWP']).to_numpy())
-    ecc.codes_set_array(output_bufr,
-        '#1#windDirection->percentConfidence->percentConfidence->percentConfidence',
-        (100 * dataframe['QI not using NWP']).to_numpy())
-    
-    ecc.codes_set_array(output_bufr,
-        '#1#windDirection->nominalConfidenceThreshold',
-        [0]*len(dataframe))
-    ecc.codes_set_array(output_bufr,
-        '#1#windDirection->nominalConfidenceThreshold->nominalConfidenceThreshold',
-        [0]*len(dataframe))
-    ecc.codes_set_array(output_bufr,
-        '#1#windDirection->nominalConfidenceThreshold->nominalConfidenceThreshold->nominalConfidenceThreshold',
-        [0]*len(dataframe))
+    return arrays
 
-    # Satellite Zenith Angle
-    ecc.codes_set_array(output_bufr, 'satelliteZenithAngle',
-                        dataframe['satzenithangle(deg.)'].to_numpy())
+
+def align_to_bin_edge(dt, bin_hours, end=False):
+    """
+    Align dt to the start of its bin, or if end to the end of its bin
+    (unless dt is already on an edge).
+    """
+    bin_size = timedelta(hours=bin_hours)
+    offset = bin_size / 2
+    midnight = datetime(dt.year, dt.month, dt.day)
+
+    aligned = dt - ((dt - midnight + offset) % bin_size)
+    if end and aligned < dt:
+        aligned += bin_size
+
+    return aligned
+
+
+def get_bin_output_path(output_dir, bin_centre):
+    centre_str = bin_centre.strftime(OUTPUT_DT_FORMAT)
+
+    return join(output_dir, "{:04d}".format(bin_centre.year),
+                "{:02d}".format(bin_centre.month),
+                centre_str, centre_str + ".bufr")
+
+
+def assign_bins(times, start_dt, bin_hours, n_bins):
+    """
+    Return the row and bin indices of the times (datetime64) in the n_bins
+    bins from start_dt, sorted by bin and then row.
+
+    As with get_wind_data the bins include both edges, compared in whole
+    seconds, so a time on an edge is in both bins.
+    """
+    bin_seconds = bin_hours * 3600
+    offset = times.astype('datetime64[ms]').astype(int64) // 1000 - \
+        int64(start_dt.replace(tzinfo=timezone.utc).timestamp())
+
+    bins = offset // bin_seconds
+    on_edge = nonzero(offset % bin_seconds == 0)[0]
+
+    rows = concatenate((arange(len(times)), on_edge))
+    bins = concatenate((bins, bins[on_edge] - 1))
+
+    valid = (bins >= 0) & (bins < n_bins)
+    rows = rows[valid]
+    bins = bins[valid]
+
+    order = lexsort((rows, bins))
+
+    return rows[order], bins[order]
+
+
+def convert_range(start_dt, end_dt, bin_hours, output_dir,
+                  satellite_list, channel_list, n_processes=N_CPU, sizing=None):
+    """
+    Write a BUFR for every bin from start_dt to end_dt. The CSVs are read
+    once for each block of RANGE_BLOCK_BINS bins and the rows routed to every
+    bin they belong to. Bins with an existing output are skipped.
+    """
+    sizing = sizing if sizing else MessageSizing()
+
+    start_dt = align_to_bin_edge(start_dt, bin_hours)
+    end_dt = align_to_bin_edge(end_dt, bin_hours, end=True)
+    bin_size = timedelta(hours=bin_hours)
+
+    # Rescan the range's months if files have arrived since they were scanned
+    inventory = get_inventory(months=get_months(start_dt, end_dt))
+
+    block_start = start_dt
+    while block_start < end_dt:
+        block_end = min(block_start + RANGE_BLOCK_BINS * bin_size, end_dt)
+        n_bins = (block_end - block_start) // bin_size
+
+        # Skip bin if the output already exists.
+        bin_starts = [block_start + i * bin_size for i in range(n_bins)]
+        output_paths = [get_bin_output_path(output_dir, b + bin_size / 2)
+                        for b in bin_starts]
+        todo = [not exists(p) for p in output_paths]
+
+        if not any(todo):
+            print("Outputs already exist from {} to {}. SKIPPING".format(
+                block_start, block_end))
+            block_start = block_end
+            continue
+
+        # Read each satellite & channel's data for the whole block once
+        #  and assign the rows to the bins
+        # (satellite, channel, coverage): (dataframe, rows, bins)
+        block_data = {}
+        for sat in satellite_list:
+            for chan in channel_list:
+                data = get_wind_data(sat, chan, block_start, block_end,
+                                     inventory=inventory)
+
+                for coverage, df in data.items():
+                    rows, bins = assign_bins(df['time(mjd)'].to_numpy(),
+                                             block_start, bin_hours, n_bins)
+                    block_data[(sat, chan, coverage)] = (df, rows, bins)
+
+        # Each bin's data_list
+        bin_data_lists = {}
+        for i in range(n_bins):
+            if not todo[i]:
+                print("Output file already exists. SKIPPING")
+                continue
+
+            data_list = []
+            for sat in satellite_list:
+                for chan in channel_list:
+                    data = {}
+                    for coverage in ['s', 'f', 'a']:
+                        if (sat, chan, coverage) not in block_data:
+                            continue
+
+                        df, rows, bins = block_data[(sat, chan, coverage)]
+                        i_start, i_end = searchsorted(bins, [i, i + 1])
+                        if i_start < i_end:
+                            data[coverage] = df.iloc[rows[i_start:i_end]]\
+                                .reset_index(drop=True)
+
+                    if len(data) > 0:
+                        data_list.append((sat, chan, data))
+
+            bin_data_lists[i] = data_list
+
+        del block_data
+
+        if n_processes <= 1:
+            for i, data_list in bin_data_lists.items():
+                print("Running from {} to {}".format(bin_starts[i],
+                                                     bin_starts[i] + bin_size))
+                print("Output file path:", output_paths[i])
+
+                write_output(output_paths[i],
+                             partial(write_bufr, data_list,
+                                     n_processes=1, sizing=sizing))
+
+            block_start = block_end
+            continue
+
+        # Prepare every bin in the block before forking one pool for them
+        #  all, so the workers' templates are reused from bin to bin
+        shared_data = []
+        bin_tasks = {}
+        for i, data_list in bin_data_lists.items():
+            prepared_list = prepare_data_list(data_list, sizing)
+            bin_tasks[i] = get_tasks(prepared_list, len(shared_data))
+            shared_data += prepared_list
+
+        del bin_data_lists
+
+        with shared_pool(shared_data, n_processes) as pool:
+            for i, tasks in bin_tasks.items():
+                print("Running from {} to {}".format(bin_starts[i],
+                                                     bin_starts[i] + bin_size))
+                print("Output file path:", output_paths[i])
+
+                write_output(output_paths[i],
+                             partial(write_tasks, pool, tasks))
+
+        block_start = block_end
 
 
 # SCRIPT
@@ -324,12 +828,12 @@ def parse_args():
                                         "Author: Joshua Torrance")
 
     parser.add_argument("-s", "--start",
-                        nargs="?", required=True, type=valid_date,
+                        nargs="?", required=False, type=valid_date,
                         help="Start UTC datetime to grab data for. Will be "
                              "aligned to the bin edge before it. "
                              "Use the format " + COMMANDLINE_DT_FORMAT)
     parser.add_argument("-e", "--end",
-                        nargs="?", required=True, type=valid_date,
+                        nargs="?", required=False, type=valid_date,
                         help="End UTC datetime to grab data for. Will be "
                              "aligned to the bin edge after it. "
                              "Use the format " + COMMANDLINE_DT_FORMAT)
@@ -345,23 +849,70 @@ def parse_args():
                         help="Name of the satellite to filter on or \"all\".")
 
     parser.add_argument("-o", "--output",
-                        nargs="?", required=True,
+                        nargs="?", required=False,
                         help="Output file path.")
 
-    return parser.parse_args()
+    parser.add_argument("--range",
+                        nargs=2, required=False, type=valid_date,
+                        metavar=("START", "END"),
+                        help="Write a BUFR for every bin from START to END "
+                             "to --output-dir rather than a single file. "
+                             "Existing outputs are skipped. "
+                             "Use the format " + COMMANDLINE_DT_FORMAT)
+    parser.add_argument("--bin-hours",
+                        required=False, type=int, default=BIN_HOURS,
+                        help="Size of the bins for --range.")
+    parser.add_argument("--output-dir",
+                        required=False,
+                        help="Output directory for --range.")
+
+    parser.add_argument("--message-subsets",
+                        required=False, type=int, default=BUFR_MESSAGE_LEN,
+                        help="Number of subsets per BUFR message.")
+    parser.add_argument("--message-bytes",
+                        required=False, type=int, default=None,
+                        help="Target size of each BUFR message in bytes, "
+                             "the number of subsets is estimated per product.")
+    parser.add_argument("--group",
+                        action="store_true",
+                        help="Order the rows by time and pressure before "
+                             "splitting them into messages.")
+    parser.add_argument("--benchmark",
+                        nargs="+", required=False, type=int, metavar="SUBSETS",
+                        help="Rather than writing a file, report the encode "
+                             "time, output size and decode time of the data "
+                             "from --start to --end for each number of "
+                             "subsets per message and the --message-bytes "
+                             "target if given, grouped if --group. "
+                             "PRODUCT_MESSAGE_SIZES is not applied.")
+    parser.add_argument("--verify-templates",
+                        action="store_true",
+                        help="Rather than writing a file, check that the "
+                             "messages copied from templates are byte "
+                             "identical to those built directly for the data "
+                             "from --start to --end.")
+
+    args = parser.parse_args()
+
+    if args.range is not None:
+        if args.output_dir is None:
+            parser.error("--output-dir is required with --range")
+    elif args.start is None or args.end is None:
+        parser.error("--start and --end are required without --range")
+    elif args.output is None and args.benchmark is None and \
+            not args.verify_templates:
+        parser.error("--output is required without --range, --benchmark "
+                     "or --verify-templates")
+
+    return args
 
 
 def main():
     args = parse_args()
 
-    start_dt = args.start
-    end_dt = args.end
-
     satellite_filter = args.satellite
     channel_filter = args.channel
 
-    output_filepath = args.output
-
     if satellite_filter == "all":
         satellite_list = SATELLITE_NAMES
     else:
@@ -372,13 +923,49 @@ def main():
     else:
         channel_list = [channel_filter]
 
-    with open(output_filepath, 'wb') as f:
-        for sat in satellite_list:
-            for chan in channel_list:
-                data = get_wind_data(sat, chan, start_dt, end_dt)
+    n_cpu = int(environ.get("PBS_NCPUS", N_CPU))
+    sizing = MessageSizing(args.message_subsets, args.message_bytes, args.group)
 
-                if len(data) > 0:
-                    data_to_bufr(data, f, sat, chan)
+    if args.range is not None:
+        convert_range(args.range[0], args.range[1], args.bin_hours,
+                      args.output_dir, satellite_list, channel_list, n_cpu,
+                      sizing)
+        return
+
+    start_dt = args.start
+    end_dt = args.end
+    output_filepath = args.output
+
+    # Find the input files from the inventory rather than globbing, rescanning
+    #  the bin's months if files have arrived since they were scanned
+    inventory = get_inventory(months=get_months(start_dt, end_dt))
+
+    data_list = []
+    for sat in satellite_list:
+        for chan in channel_list:
+            data = get_wind_data(sat, chan, start_dt, end_dt,
+                                 inventory=inventory)
+
+            if len(data) > 0:
+                data_list.append((sat, chan, data))
+
+    if args.benchmark is not None:
+        sizings = [MessageSizing(subsets, group=args.group, product_sizes=False)
+                   for subsets in args.benchmark]
+        if args.message_bytes:
+            sizings.append(MessageSizing(args.message_subsets, args.message_bytes,
+                                         args.group, product_sizes=False))
+
+        benchmark_sizing(data_list, sizings)
+        return
+
+    if args.verify_templates:
+        if verify_templates(data_list, sizing) > 0:
+            exit(1)
+        return
+
+    with open(output_filepath, 'wb') as f:
+        write_bufr(data_list, f, n_cpu, sizing)
 
 
 if __name__ == "__main__":
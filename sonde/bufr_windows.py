@@ -0,0 +1,175 @@
+# Helpers for sorting BUFR messages into the 6-hourly BARRA2 windows.
+#
+# The windows are centred on 0, 6, 12 and 18Z, i.e.
+#   21Z-3Z -> 0Z (of the next day if after 21Z), 3Z-9Z -> 6Z,
+#   9Z-15Z -> 12Z, 15Z-21Z -> 18Z
+# and the binned files are organised as
+#   YYYY/MM/YYYYMMDDTHH00Z/<file name>
+# matching the output of organise_bufr.py.
+#
+# Author: Joshua Torrance
+
+# IMPORTS
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from os import makedirs, remove, replace
+from os.path import join, exists
+
+import eccodes as ecc
+
+
+# PARAMETERS
+WINDOW_HOURS = 6
+
+# Maximum number of window files to hold open at once
+MAX_OPEN_FILES = 32
+
+TEMP_EXTENSION = ".temp"
+
+
+# FUNCTIONS
+def get_window_centre(date_time):
+    """
+    Return the centre of the 6 hour window containing date_time.
+    Only the hour is considered and the result is timezone naive.
+    """
+    return datetime(date_time.year, date_time.month, date_time.day) + \
+        timedelta(hours=WINDOW_HOURS * ((date_time.hour + WINDOW_HOURS // 2)
+                                        // WINDOW_HOURS))
+
+
+def get_window_dir(bins_dir, window):
+    return join(bins_dir,
+                "{:04d}".format(window.year),
+                "{:02d}".format(window.month),
+                window.strftime("%Y%m%dT%H00Z"))
+
+
+def get_message_datetime(msgid):
+    """
+    Return the typical (section 1) date and hour of a BUFR message. These
+    are header keys so the data section isn't unpacked. sonde.py sets them
+    to the launch time, century as floor(year / 100) for edition 3.
+    """
+    if ecc.codes_get(msgid, 'edition') >= 4:
+        year = ecc.codes_get(msgid, 'typicalYear')
+    else:
+        year = 100 * ecc.codes_get(msgid, 'typicalCentury') + \
+            ecc.codes_get(msgid, 'typicalYearOfCentury')
+
+    return datetime(year,
+                    ecc.codes_get(msgid, 'typicalMonth'),
+                    ecc.codes_get(msgid, 'typicalDay'),
+                    ecc.codes_get(msgid, 'typicalHour'))
+
+
+def bin_bufr_file(bufr_path, bins_dir, file_name_template):
+    """
+    Copy each message of bufr_path into its window file, replacing any
+    existing window files. Returns the number of messages written.
+    """
+    n_messages = 0
+    with open(bufr_path, 'rb') as f_in, \
+            WindowedBufrWriter(bins_dir, file_name_template) as writer:
+        while True:
+            msgid = ecc.codes_bufr_new_from_file(f_in)
+            if msgid is None:
+                break
+
+            try:
+                writer.write(get_message_datetime(msgid),
+                             ecc.codes_get_message(msgid))
+                n_messages += 1
+            finally:
+                ecc.codes_release(msgid)
+
+    return n_messages
+
+
+# CLASSES
+class WindowedBufrWriter:
+    """
+    Write BUFR messages to per-window files.
+
+    Each window's output is written to a temp file, at most max_open_files
+    are held open at once (least recently used are closed first). On close
+    the temp files are renamed to their final names, replacing any existing
+    files. If an exception occurs inside a with block the temp files are
+    deleted instead.
+
+    file_name_template is formatted with the window's datetime, e.g.
+    "ASM00094120-{window:%Y%m%d%H00}.bufr"
+    """
+
+    def __init__(self, bins_dir, file_name_template,
+                 max_open_files=MAX_OPEN_FILES):
+        self.bins_dir = bins_dir
+        self.file_name_template = file_name_template
+        self.max_open_files = max_open_files
+
+        # window: open file, in least recently used order
+        self._open_files = OrderedDict()
+
+        # window: output path
+        self.outputs = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def get_output_path(self, window):
+        return join(get_window_dir(self.bins_dir, window),
+                    self.file_name_template.format(window=window))
+
+    def _get_file(self, window):
+        f = self._open_files.get(window)
+        if f is not None:
+            self._open_files.move_to_end(window)
+            return f
+
+        if len(self._open_files) >= self.max_open_files:
+            _, oldest = self._open_files.popitem(last=False)
+            oldest.close()
+
+        if window in self.outputs:
+            # Seen this window before, carry on where it left off
+            f = open(self.outputs[window] + TEMP_EXTENSION, 'ab')
+        else:
+            output_path = self.get_output_path(window)
+            makedirs(get_window_dir(self.bins_dir, window), exist_ok=True)
+
+            self.outputs[window] = output_path
+            f = open(output_path + TEMP_EXTENSION, 'wb')
+
+        self._open_files[window] = f
+
+        return f
+
+    def write(self, date_time, message):
+        """
+        Write the bytes of an encoded message to the window for date_time.
+        """
+        self._get_file(get_window_centre(date_time)).write(message)
+
+    def _close_files(self):
+        for f in self._open_files.values():
+            f.close()
+        self._open_files.clear()
+
+    def close(self):
+        self._close_files()
+
+        for output_path in self.outputs.values():
+            replace(output_path + TEMP_EXTENSION, output_path)
+
+    def abort(self):
+        self._close_files()
+
+        for output_path in self.outputs.values():
+            if exists(output_path + TEMP_EXTENSION):
+                remove(output_path + TEMP_EXTENSION)
@@ -2,13 +2,15 @@
 
 from datetime import datetime
 from glob import glob
-from os import readlink
+from multiprocessing import Pool
+from os import readlink, replace, environ
 from os.path import basename, join, exists, islink, isabs, dirname, isdir
 ## IMPORTS
 from sys import argv
 from sys import path
+from time import time
 
-from pandas import DataFrame, concat
+from pandas import DataFrame
 
 # Import custom modules
 path.insert(1, "/g/data/hd50/jt4085/BARRA2/util/bufr")
@@ -20,16 +22,32 @@ from eccodes_wrapper import BufrFile
 OLD_BUFR_DIR = "/g/data/hd50/barra2/data/obs/production"
 OUTPUT_DIR = "/scratch/hd50/jt4085/sonde/sonde_types"
 
+# Multiprocessing, the number of processes is taken from PBS_NCPUS
+#  otherwise N_CPU
+N_CPU = 1
+
+COLUMNS = ["Latitude", "Longitude",
+           "WMO Station Number",
+           "WMO Block Number",
+           "Ship or Mobile Station Identifier",
+           "Datetime", "Radiosonde Type"]
 
-## Functions
-def get_values_from_bufr(filepath):
-    data = []
-    with BufrFile(filepath) as bufr:
-        print("\t\t\t\tMessage Count:",
-              bufr.get_number_messages())
 
+## Functions
+def get_values_from_bufr(filepath, first_seen):
+    """
+    Read the location, ids, time and radiosondeType of each message and
+    record the first-seen row for each (station, type) in first_seen.
+
+    radiosondeType is only in the data section so each message has to be
+    unpacked whatever the header holds, but it's unpacked without the
+    attribute keys as only the values are read.
+    """
+    n_messages = 0
+    with BufrFile(filepath, unpack=False) as bufr:
         for msg in bufr.get_messages():
-            lat, lon = msg.get_locations()
+            n_messages += 1
+            msg.unpack(skip_attributes=True)
 
             station_number = None
             block_number = None
@@ -63,38 +81,19 @@ def get_values_from_bufr(filepath):
 
             sonde_type = msg.get_value("radiosondeType")
 
-            if False:
-                print("\t\t\t\tLat, Lon:", lat, lon)
-                print("\t\t\t\tWMO Station number:", station_number)
-                print("\t\t\t\tWMO Block Number:", block_number)
-                print("\t\t\t\tShip or Mobile Station ID:",
-                      ship_or_mobile_station_number)
-                print("\t\t\t\tDatetime:", dt)
-                print("\t\t\t\tRadiosonde Type:", sonde_type)
-                print()
-
-            data.append({
-                "Latitude": lat,
-                "Longitude": lon,
-                "WMO Station Number": station_number,
-                "WMO Block Number": block_number,
-                "Ship or Mobile Station Identifier":
-                    ship_or_mobile_station_number,
-                "Datetime": dt,
-                "Radiosonde Type": sonde_type
-            })
-
-    # Build a dataframe, drop duplicates radiosonde types for a given station
-    # Dedup will be performed later too
-    df = DataFrame(data=data) \
-        .sort_values(by="Datetime") \
-        .drop_duplicates(
-            subset=["WMO Station Number", "WMO Block Number",
-                    "Ship or Mobile Station Identifier", "Radiosonde Type"],
-            keep='first')
-
-    # Dedup df on 
-    return df
+            # Drop duplicate radiosonde types for a given station,
+            #  keeping the earliest
+            key = (station_number, block_number,
+                   ship_or_mobile_station_number, sonde_type)
+            if key in first_seen and first_seen[key][5] <= dt:
+                continue
+
+            lat, lon = msg.get_locations()
+
+            first_seen[key] = (lat, lon, station_number, block_number,
+                               ship_or_mobile_station_number, dt, sonde_type)
+
+    print("\t\t\t\tMessage Count:", n_messages)
 
 
 def process_month(input_dir, output_path):
@@ -103,11 +102,8 @@ def process_month(input_dir, output_path):
         print("\t\tType data for this month already exists, skipping.")
         return
 
-    df = DataFrame([], columns=["Latitude", "Longitude",
-                                "WMO Station Number",
-                                "WMO Block Number",
-                                "Ship or Mobile Station Identifier",
-                                "Datetime", "Radiosonde Type"])
+    # (station, block, ship, type): row
+    first_seen = {}
 
     for dt_dir in sorted(glob(join(input_dir, "*"))):
         dt = basename(dt_dir)
@@ -128,24 +124,31 @@ def process_month(input_dir, output_path):
 
                 bufr_filepath = target
 
-            new_df = get_values_from_bufr(bufr_filepath)
+            get_values_from_bufr(bufr_filepath, first_seen)
 
-            # Concatenate dataframe
-            #  drop duplicate radiosonde types for a given station
-            df = concat((df, new_df)) \
-                .sort_values(by="Datetime") \
-                .drop_duplicates(
-                    subset=["WMO Station Number", "WMO Block Number",
-                            "Ship or Mobile Station Identifier",
-                            "Radiosonde Type"],
-                    keep='first')
+    # Build the dataframe once for the month
+    df = DataFrame(list(first_seen.values()), columns=COLUMNS) \
+        .sort_values(by="Datetime", kind="stable")
 
-    # Output dataframe to file.
-    df.to_csv(output_path, index=False)
+    # Output dataframe to file, via a temp file so an interrupted month
+    #  isn't mistaken for a finished one.
+    temp_output_path = output_path + ".temp"
+    df.to_csv(temp_output_path, index=False)
+    replace(temp_output_path, output_path)
+
+
+def _process_month(month):
+    m_dir, output_path = month
+    start_time = time()
+
+    process_month(m_dir, output_path)
+
+    return m_dir, time() - start_time
 
 
 ## SCRIPT
 def main():
+    months = []
     for y_dir in sorted(glob(join(OLD_BUFR_DIR, "*"))):
         if not isdir(y_dir):
             continue
@@ -176,8 +179,16 @@ def main():
             sonde_type_csv_path = join(OUTPUT_DIR,
                 "{year}-{month}_sonde_types.csv".format(year=y, month=m))
 
-            process_month(m_dir, sonde_type_csv_path)
+            months.append((m_dir, sonde_type_csv_path))
+
+    # Each month is independent, process them in parallel
+    n_cpu = int(environ.get("PBS_NCPUS", N_CPU))
+    print("Processing {} months with {} processes".format(len(months), n_cpu))
+
+    with Pool(n_cpu) as pool:
+        for m_dir, elapsed in pool.imap_unordered(_process_month, months):
+            print("Finished {} in {:.1f}s".format(m_dir, elapsed))
+
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,118 @@
+# A manifest of the sonde conversion inputs and outputs.
+#
+# One small JSON file is kept per station zip recording the zip's
+# size/mtime/hash, the bias file's path/mtime/hash, the sonde type timeline's
+# path/mtime/hash, the converter version and the output's hash. With it
+# run_conversion.py can reconvert only the stations whose inputs or
+# converter have changed.
+#
+# One file per station (rather than a single manifest) means concurrent
+# conversion jobs never contend over the same file.
+#
+# Author: Joshua Torrance
+
+# IMPORTS
+from hashlib import sha1
+from json import load, dump
+from os import replace, getpid, stat
+from os.path import join, exists
+
+
+# PARAMETERS
+MANIFEST_EXTENSION = ".json"
+
+# Read files in 1 MB blocks when hashing
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+# FUNCTIONS
+def file_sha1(file_path):
+    h = sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def file_details(file_path, previous=None):
+    """
+    Return the path, size, mtime and hash of file_path.
+
+    If previous details are given and the path, size and mtime are
+    unchanged the previous hash is reused rather than reading the file.
+    """
+    if file_path is None:
+        return None
+
+    file_stat = stat(file_path)
+    details = {"path": file_path,
+               "size": file_stat.st_size,
+               "mtime": file_stat.st_mtime}
+
+    if previous and \
+            previous["path"] == details["path"] and \
+            previous["size"] == details["size"] and \
+            previous["mtime"] == details["mtime"]:
+        details["sha1"] = previous["sha1"]
+    else:
+        details["sha1"] = file_sha1(file_path)
+
+    return details
+
+
+def _manifest_path(manifest_dir, name):
+    return join(manifest_dir, name + MANIFEST_EXTENSION)
+
+
+def load_manifest_entry(manifest_dir, name):
+    manifest_path = _manifest_path(manifest_dir, name)
+
+    if not exists(manifest_path):
+        return None
+
+    with open(manifest_path, 'r') as f:
+        return load(f)
+
+
+def save_manifest_entry(manifest_dir, name, entry):
+    # Write to a temp file and rename so a reader never sees a partial entry
+    manifest_path = _manifest_path(manifest_dir, name)
+    temp_path = "{}.{}.temp".format(manifest_path, getpid())
+
+    with open(temp_path, 'w') as f:
+        dump(entry, f, indent=1, sort_keys=True)
+
+    replace(temp_path, manifest_path)
+
+
+def _same_content(details, previous):
+    if details is None or previous is None:
+        return details is None and previous is None
+
+    return details["path"] == previous["path"] and \
+        details["sha1"] == previous["sha1"]
+
+
+def is_up_to_date(entry, zip_details, bias_details, converter_version,
+                  output_file, types_details=None):
+    """
+    True if output_file exists and was converted from the same zip, bias
+    and sonde type timeline content with the same converter version.
+    """
+    return entry is not None and \
+        exists(output_file) and \
+        entry.get("converter version") == converter_version and \
+        _same_content(zip_details, entry.get("zip")) and \
+        _same_content(bias_details, entry.get("bias")) and \
+        _same_content(types_details, entry.get("types"))
+
+
+def build_manifest_entry(station_code, zip_details, bias_details,
+                         converter_version, output_file, types_details=None):
+    return {"station": station_code,
+            "zip": zip_details,
+            "bias": bias_details,
+            "types": types_details,
+            "converter version": converter_version,
+            "output": file_details(output_file)}
@@ -4,16 +4,13 @@ from pandas import read_csv
 from matplotlib import pyplot as plt
 from glob import glob
 from os.path import basename
-from sys import path
-from numpy import concatenate
+from numpy import nan
 from datetime import datetime
 from random import shuffle
 
-from sonde_bufr_check import get_station_location
+from station_catalog import get_station_catalog
+from sonde_profiles import read_sonde_profiles, MISSING_DOUBLE, MISSING_LONG
 
-# Import custom modules
-path.insert(1, "/g/data/hd50/jt4085/BARRA2/util/bufr")
-from eccodes_wrapper import BufrFile
 
 ## PARAMETERS
 # Input files
@@ -37,6 +34,8 @@ barra_filter = (BARRA_LEFT, BARRA_RIGHT, BARRA_BOTTOM, BARRA_TOP)
 # Script
 def main():
     # Find a bufr in the barra region
+    catalog = get_station_catalog()
+
     converted_bufrs = glob(CONVERTED_DIR)
     shuffle(converted_bufrs)
     for f in converted_bufrs:
@@ -45,55 +44,27 @@ def main():
         station_name = basename(f)[:11]
 
         station_lat, station_lon = \
-            get_station_location(station_name)
+            catalog.get_location(station_name)
 
         print("\t", station_lat, station_lon)
 
-        if (BARRA_BOTTOM < station_lat < BARRA_TOP) and \
-            ((BARRA_LEFT < BARRA_RIGHT) and \
-                 (BARRA_LEFT < station_lon < BARRA_RIGHT) or \
-             (BARRA_LEFT > BARRA_RIGHT) and \
-                 (BARRA_LEFT < station_lon or station_lon < BARRA_RIGHT)):
+        # Skip mobile stations, they have no fixed location to compare
+        if station_lat is not None and station_lon is not None and \
+                catalog.is_in_region(station_name,
+                                     BARRA_LEFT, BARRA_RIGHT,
+                                     BARRA_BOTTOM, BARRA_TOP):
             print("\t\tIn region")
 
             station_filepath = f
             break
 
-    # Get the data from the bufr
-    station_wind_speed = []
-    station_wind_dir = []
-    station_air_temp = []
-    station_pressure = []
-    with BufrFile(station_filepath) as bufr:
-        for msg in bufr.get_messages():
-            station_wind_speed = concatenate((station_wind_speed,
-                                              msg.get_value("windSpeed")))
-
-            station_wind_dir = concatenate((station_wind_dir,
-                                            msg.get_value("windDirection")))
-
-            replication_factor = msg.get_value("extendedDelayedDescriptorReplicationFactor")
-
-            pressure = []
-            air_temp = []
-            for i in range(replication_factor):
-                val = msg.get_value("#{}#pressure".format(i+1))
-                pressure.append(val if val!="MISSING" else float("NaN"))
-
-                val = msg.get_value("#{}#airTemperature".format(i+1))
-                air_temp.append(val if val!="MISSING" else float("NaN"))
-
-            station_pressure = concatenate((station_pressure,
-                                            pressure))
-            station_air_temp = concatenate((station_air_temp,
-                                            air_temp))
-
-    # Replace missing values with NaN
-    station_wind_speed = [ws if ws!=-1e100 else float("NaN")
-                          for ws in station_wind_speed]
-    station_wind_dir = [wd if wd!=2147483647 else float("NaN")
-                        for wd in station_wind_dir]
-
+    # Get the data from the bufr, all levels of all soundings at once
+    profiles = read_sonde_profiles(station_filepath,
+                                   keys=["airTemperature", "windDirection",
+                                         "windSpeed"])
+    station_air_temp = profiles.values["airTemperature"]
+    station_wind_dir = profiles.values["windDirection"]
+    station_wind_speed = profiles.values["windSpeed"]
 
     # Load the CSV
     prod_df = read_csv(PRODUCTION_DUMP)
@@ -111,12 +82,9 @@ def main():
     # Explode the columns together
     prod_df = prod_df.explode(cols_to_explode).reset_index()
 
-    # Replace MISSING values with NaN
-    missing_vals = ["-1e+100", "2147483647"]
-    prod_df = prod_df.replace(to_replace=missing_vals, value='NaN')
-
-    # Convert elements to numbers
-    prod_df = prod_df.applymap(float)
+    # Convert elements to numbers, replacing MISSING values with NaN
+    prod_df = prod_df.astype(float) \
+        .replace(to_replace=[MISSING_DOUBLE, MISSING_LONG], value=nan)
 
 
     # Filter df to barra region
@@ -1,16 +1,51 @@
 #!/bin/bash
 
-# This script simply submits a number of jobs with a passing the
-# job number as an argument.
+# This script simply submits a number of identical jobs.
+# The jobs share the stations between them via lock files so any number
+# can run at once, each job hands the stations out to its own pool
+# biggest first.
+#
+# With --incremental only stations whose inputs or converter have changed
+# are reconverted, then run "meta_submit_jobs_organise_bufr.sh --changed".
+#
+# With --bin the 6-hourly bins are written during conversion and
+# organise_bufr.py isn't needed.
+#
+# With --seed-manifest the manifest entries are written for the existing
+# outputs without converting anything, run this once before the first
+# --incremental.
+#
+# The bias file index is built before the jobs are submitted so they all
+# start from the same, complete index.
 
 job_script=/g/data/hd50/jt4085/BARRA2/sonde/submit_job_convert_sonde.sh
+conversion_script=/g/data/hd50/jt4085/BARRA2/sonde/run_conversion.py
 
-N=100
+N=10
 
-for i in $(seq 0 $N); do
+# The jobs share a submission id so each station is only processed by one
+# of them, the rest skip it once it's done
+job_vars=",submission=$(date +%Y%m%dT%H%M%S)"
+for arg in "$@"; do
+    if [[ "$arg" == "--incremental" ]]; then
+        job_vars="$job_vars,incremental=1"
+    elif [[ "$arg" == "--bin" ]]; then
+        job_vars="$job_vars,bin=1"
+    elif [[ "$arg" == "--seed-manifest" ]]; then
+        job_vars="$job_vars,seed_manifest=1"
+    fi
+done
+
+job_vars="-v ${job_vars:1}"
+
+# Build the bias file index once here rather than in every job
+module load python3/3.8.5
+module load eccodes3
+python3 $conversion_script --build-bias-index || exit 1
+
+for i in $(seq 1 $N); do
     echo $i
-    qsub -v job_num=$i $job_script
+    qsub $job_vars $job_script
 done
 
 echo "Script finished"
-
@@ -2,6 +2,10 @@
 
 # This job iterates through a directory of bufr files then passes
 # each one to submit_job_organise_bufrs.sh
+#
+# With --changed only the stations listed by
+# "run_conversion.py --incremental" are binned, overwriting their
+# existing bins.
 
 job_script=/g/data/hd50/jt4085/BARRA2/sonde/submit_job_organise_bufr.sh
 
@@ -11,8 +15,24 @@ file_list_script=/g/data/hd50/jt4085/BARRA2/sonde/get_list_of_barra_stations.sh
 bufr_file_dir=/scratch/hd50/jt4085/sonde/data-bufr
 bufr_file_str="$bufr_file_dir/*.bufr"
 
+# Written by run_conversion.py --incremental
+changed_stations_list=$bufr_file_dir/manifest/changed_stations.txt
+
 NUMBER_OF_JOBS=100
 
+if [[ "$1" == "--changed" ]]; then
+    # Move the list aside first so stations added by conversion jobs
+    # while we're submitting go to a fresh list rather than being lost
+    submitting_list=$changed_stations_list.$$.submitting
+    mv $changed_stations_list $submitting_list || exit 1
+
+    file_list_cmd="sort -u $submitting_list"
+    overwrite=overwrite
+else
+    file_list_cmd=$file_list_script
+    overwrite=""
+fi
+
 # Calculate the batch size
 # No ceil in bash so get python to do it.
 num_files=`ls $bufr_file_str | wc -l`
@@ -27,13 +47,19 @@ for start_year in 2007 2011 2015 2019; do
     # Use xargs to pass each set to qsub
     # Use shuf to shuffle the files to avoid blocking goegraphically similar files
     #ls $bufr_file_str \
-    $file_list_script \
+    $file_list_cmd \
     | shuf \
     | xargs -n $batch_size \
     | xargs -I {} \
-        qsub -v files_list="{}",start_year=$start_year,end_year=$end_year \
+        qsub -v files_list="{}",start_year=$start_year,end_year=$end_year,overwrite=$overwrite \
             $job_script
 done
 
-echo "Job submission script finished"
+if [[ "$1" == "--changed" ]]; then
+    # The changes have been submitted, add them to the record of
+    # submitted stations
+    cat $submitting_list >> $changed_stations_list.submitted \
+        && rm $submitting_list
+fi
 
+echo "Job submission script finished"
@@ -9,25 +9,34 @@
 # Author: Joshua Torrance (joshua.torrance@bom.gov.au)
 
 # IMPORTS
-from sys import argv
+from argparse import ArgumentParser
 from glob import glob
-from os import remove as delete_file, rmdir
-from os.path import join, basename, exists, splitext
-from shutil import move
+from os import remove as delete_file, replace, getpid, environ, makedirs, \
+    fdopen, open as os_open, O_CREAT, O_EXCL, O_WRONLY, rename, link, stat
+from os.path import join, basename, dirname, exists, splitext, getmtime, \
+    getsize
+from socket import gethostname
+from time import time
+from csv import DictReader, DictWriter
 from zipfile import ZipFile
-from subprocess import run
+from io import TextIOWrapper
 from netCDF4 import Dataset
 from datetime import datetime
 from multiprocessing.pool import Pool
 from functools import partial
-from re import search
 
-from sonde_bufr_converter import do_conversion
-from igra2_sonde_type import meta_sonde_type_dict_list
+from sonde_bufr_converter import convert_txt_file, CONVERTER_VERSION
+from conversion_manifest import load_manifest_entry, save_manifest_entry, \
+    file_details, is_up_to_date, build_manifest_entry
+from sonde_type_matcher import get_sonde_type_timelines
+from station_catalog import get_station_catalog
+from sonde_type_index import SondeTypeIndex, SONDE_TYPE_TIMELINE_PATH
+from bufr_windows import bin_bufr_file
 
 
 # PARAMETERS
 # Multiprocessing
+# The number of processes is taken from PBS_NCPUS, otherwise N_CPU
 N_CPU = 1
 
 # IGRA Data Details
@@ -41,10 +50,6 @@ SONDE_TXT_INPUT_DIR = join(IGRA_FILE_DIR, "data-por")
 SONDE_TXT_ZIP_EXTENSION = ".zip"
 SONDE_TXT_EXTENSION = ".txt"
 
-# A temporary directory to unpack the zips into
-# Temp file can be on scratch
-TEMP_DIR = "/scratch/hd50/jt4085/sonde/temp"
-
 # raobcore/ERA5 Details
 ERA5_FILE_DIR = "/g/data/hd50/barra2/data/obs/raobcore"
 
@@ -52,13 +57,42 @@ ERA5_FILE_DIR = "/g/data/hd50/barra2/data/obs/raobcore"
 SONDE_NC_INPUT_DIR = join(ERA5_FILE_DIR, "ERA5_v7")
 SONDE_NC_EXTENSION = ".nc"
 
+# Index of the bias files' station names, saves opening every bias file
+# in every job. Refreshed for any files whose mtime has changed. It's kept
+# with our other caches rather than in the shared ERA5 directory, which
+# we can't write to, and is built once by meta_submit_jobs_convert_sonde.sh
+# (--build-bias-index) before the jobs start.
+BIAS_INDEX_PATH = "/scratch/hd50/jt4085/sonde/ERA5_v7_station_index.csv"
+BIAS_INDEX_FIELDS = ["path", "mtime", "station name", "latitude", "longitude"]
+
 # Template .bufr file, used to create new .bufrs
 TEMPLATE_BUFR = "/g/data/hd50/jt4085/BARRA2/sonde/data/temp.bufr"
 
 # Output directory
 BUFR_EXTENSION = ".bufr"
+TEMP_EXTENSION = ".temp"
 OUTPUT_DIR = "/scratch/hd50/jt4085/sonde/data-bufr"
 
+# 6-hourly binned output, YYYY/MM/YYYYMMDDTHH00Z/<station>-<YYYYMMDDHH00>.bufr
+BINS_DIR = "/scratch/hd50/jt4085/sonde/data-bufr-bins"
+
+# Manifest of each station's inputs and outputs for --incremental
+MANIFEST_DIR = join(OUTPUT_DIR, "manifest")
+# The output each station's bins were last written from, --bin only
+#   re-bins an existing output if it's changed since
+BINNED_SUFFIX = "-binned"
+# Outputs changed by --incremental are appended here
+CHANGED_STATIONS_PATH = join(MANIFEST_DIR, "changed_stations.txt")
+
+# Lock files to share the stations between concurrent jobs
+LOCK_DIR = join(OUTPUT_DIR, "locks")
+LOCK_EXTENSION = ".lock"
+# Locks older than this are from a killed job, matches the PBS walltime
+LOCK_TIMEOUT_SEC = 10 * 60 * 60
+# Stations finished by one of a submission's jobs are marked in
+#   LOCK_DIR/<submission>/ so its other jobs skip them
+DONE_EXTENSION = ".done"
+
 # Barra region
 BARRA_LEFT = 90.00
 BARRA_RIGHT = 210.0 - 360
@@ -67,154 +101,185 @@ BARRA_TOP = 15.00
 
 
 # FUNCTIONS
-def grep(file_path, regex):
-    # Just use grep itself.
-    ret = run(["grep", regex, file_path], capture_output=True)
+def _read_bias_file_details(f_bias):
+    # Open the bias file to get the station name and location
+    with Dataset(f_bias, "r", format="NETCDF4") as nc:
+        station_name = nc.__dict__['Stationnname'].strip()
+
+        location = []
+        for keys in (("lat", "latitude"), ("lon", "longitude")):
+            value = float("NaN")
+            for key in keys:
+                if key in nc.variables:
+                    value = float(nc.variables[key][:].flat[0])
+                    break
+            location.append(value)
+
+    return {"path": f_bias,
+            "mtime": getmtime(f_bias),
+            "station name": station_name,
+            "latitude": location[0],
+            "longitude": location[1]}
+
+
+def load_bias_index(index_path=BIAS_INDEX_PATH):
+    # Returns a dictionary of path: details
+    index = {}
+    if exists(index_path):
+        with open(index_path, "r", newline="") as f:
+            for row in DictReader(f):
+                row["mtime"] = float(row["mtime"])
+                row["latitude"] = float(row["latitude"])
+                row["longitude"] = float(row["longitude"])
+
+                index[row["path"]] = row
+
+    return index
+
+
+def save_bias_index(index, index_path=BIAS_INDEX_PATH):
+    # Write to a temp file then rename so other jobs never read a
+    # partially written index.
+    temp_index_path = "{}.{}.temp".format(index_path, getpid())
+    try:
+        makedirs(dirname(index_path), exist_ok=True)
+        with open(temp_index_path, "w", newline="") as f:
+            writer = DictWriter(f, fieldnames=BIAS_INDEX_FIELDS)
+            writer.writeheader()
+            for path in sorted(index):
+                writer.writerow(index[path])
 
-    # Decode from bytes string and return
-    return ret.stdout.decode("utf-8")
+        replace(temp_index_path, index_path)
+    except OSError as e:
+        # Not being able to save the index isn't fatal.
+        print("Unable to save bias index ({}): {}".format(index_path, e))
+
+
+def update_bias_index(bias_directory, index_path=BIAS_INDEX_PATH,
+                      bias_extension=SONDE_NC_EXTENSION):
+    """
+    Load the bias index and refresh it for any bias files that are new or
+    whose mtime has changed. Only those files are opened.
+    """
+    old_index = load_bias_index(index_path)
+
+    index = {}
+    n_updated = 0
+    for f_bias in sorted(glob(join(bias_directory, "*" + bias_extension))):
+        details = old_index.get(f_bias)
+
+        if details is None or details["mtime"] != getmtime(f_bias):
+            details = _read_bias_file_details(f_bias)
+            n_updated += 1
+
+        index[f_bias] = details
+
+    if n_updated > 0 or len(index) != len(old_index):
+        print("Bias index: {} of {} files updated, saving."
+              .format(n_updated, len(index)))
+        save_bias_index(index, index_path)
+
+    return index
 
 
 def get_bias_correction_stations(bias_directory,
                                  bias_extension=SONDE_NC_EXTENSION):
-    # Get a list of bias files
-    bias_files = glob(join(bias_directory,
-                           "*" + bias_extension))
-
-    # Look through each files and determine the station name
-    bias_dicts = []
-    for f_bias in bias_files:
-        with Dataset(f_bias, "r", format="NETCDF4") as nc:
-            station_name = nc.__dict__['Stationnname'].strip()
+    # Build a dictionary of station name: bias details from the index
+    # If there are duplicate names the first path (sorted) wins.
+    index = update_bias_index(bias_directory,
+                              bias_extension=bias_extension)
 
-        bias_dicts.append({"path": f_bias,
-                           "station name": station_name})
+    biases = {}
+    for path in sorted(index):
+        details = index[path]
+        biases.setdefault(details["station name"], details)
 
-    return bias_dicts
+    return biases
 
 
 def get_station_name_from_code(station_code,
                                station_list_file=IGRA_STATION_LIST_PATH):
     # Get the name of the station matching the station code
-    result = grep(station_list_file, station_code)
-    if result == '':
-        raise ValueError("Station code ({}) not found.".format(station_code))
-    else:
-        return str(result[41:71].strip())
+    return get_station_catalog(station_list_file).get_name(station_code)
 
 
 def get_station_location(station_code,
                          station_list_file=IGRA_STATION_LIST_PATH):
-    station_line = grep(station_list_file, station_code)
+    # lat/lon are None for mobile stations
+    return get_station_catalog(station_list_file).get_location(station_code)
 
-    lat = float(station_line[12:20])
-    lon = float(station_line[21:30])
 
-    # Check if lat/lon are mobile stations
-    if lat == -98.8888:
-        lat = None
-    if lon == -998.8888:
-        lon = None
+def is_station_in_barra2_region(station_code):
+    # Mobile stations are considered to be in the region.
+    return get_station_catalog(IGRA_STATION_LIST_PATH).is_in_region(
+        station_code, BARRA_LEFT, BARRA_RIGHT, BARRA_BOTTOM, BARRA_TOP)
 
-    return lat, lon
 
+def get_station_metadata(station_code):
+    # Returns a list of (datetime, sonde type id) for the station
+    # The metadata is parsed and matched once per process.
+    return get_sonde_type_timelines(IGRA_METADATA_PATH).get_timeline(station_code)
 
-def is_station_in_barra2_region(station_code):
-    lat, lon = get_station_location(station_code)
 
-    if lat is None or lon is None:
-        # Mobile station, let's say it is in the region.
-        return True
-    elif BARRA_BOTTOM < lat < BARRA_TOP and \
-        ( (BARRA_LEFT < BARRA_RIGHT) and \
-          (BARRA_LEFT < lon < BARRA_RIGHT) ) or \
-        ( (BARRA_LEFT > BARRA_RIGHT) and \
-          (BARRA_LEFT < lon or lon < BARRA_RIGHT) ):
-        return True
-    else:
-        return False
+def _record_binned(name, output_file, previous=None):
+    # Record the output the station's bins were written from
+    save_manifest_entry(MANIFEST_DIR, name + BINNED_SUFFIX,
+                        {"output": file_details(output_file, previous)})
 
 
-def get_station_metadata(station_code):
-    meta_data = grep(IGRA_METADATA_PATH, station_code + ".*SONDE MODEL")
-
-    sonde_types = []
-    for l in meta_data.split('\n'):
-        if len(l) > 0:
-            year = int(l[84:88])
-            month = int(l[89:91])
-            month = month if month!=99 else 1
-            day = int(l[92:94])
-            day = day if day!=99 else 1
-            hour = int(l[95:97])
-            hour = hour if hour!=99 else 1
-
-            dt = datetime(year=year,
-                          month=month,
-                          day=day,
-                          hour=hour)
-
-            event = l[100:119]
-
-            sonde_model_before = l[123:163].strip()
-            sonde_model_after = l[168:208].strip()
-
-            if sonde_model_after and \
-                sonde_model_after!="" and sonde_model_after!="NONE":
-                sonde_model = sonde_model_after
-            else:
-                sonde_model = sonde_model_before
-
-            print(l)
-            print("\tDatetime:", dt)
-            print("\tEvent:", event)
-            print("\tBefore:", sonde_model_before)
-            print("\tAfter:", sonde_model_after)
-            print("\tModel:", sonde_model)
-
-            for d in meta_sonde_type_dict_list:
-                reg = d["regex"]
-                if reg and search(d["regex"], sonde_model):
-                    sonde_name = d["name"]
-                    sonde_id = d["id"]
-                    print("\tSonde name:", sonde_name)
-                    print("\tSonde ID:", sonde_id)
+def _bin_existing_output(f_zip, output_file, name):
+    """
+    Bin an output converted before the bins were asked for, unless its
+    bins have already been written from the same content.
+    """
+    binned = load_manifest_entry(MANIFEST_DIR, name + BINNED_SUFFIX)
+    previous = binned["output"] if binned else None
+    output_details = file_details(output_file, previous)
 
-                    break
-            else:
-                print("\tNo match found!")
-                exit()
+    if previous and previous["sha1"] == output_details["sha1"]:
+        print("Output file ({}) already exists and is binned, skipping..."
+              .format(basename(output_file)))
+        if output_details != previous:
+            # Record the new mtime so the hash isn't recalculated
+            _record_binned(name, output_file, previous)
+        return
 
-            sonde_types.append((dt, sonde_id))
+    print("Output file ({}) already exists, binning it..."
+          .format(basename(output_file)))
+    n_messages = bin_bufr_file(output_file, BINS_DIR,
+                               basename(f_zip)[:11] + "-{window:%Y%m%d%H00}.bufr")
+    print("\tBinned {} messages".format(n_messages))
 
-            print()
+    _record_binned(name, output_file, previous)
 
-    return sonde_types
 
-def _process_zip(f_zip, biases):
+def _process_zip(f_zip, biases, incremental=False, bin_output=False,
+                 type_index=None, seed_manifest=False, types_details=None):
     print(basename(f_zip))
 
-    # Unpack the zip
-    zip_dir = join(TEMP_DIR, basename(f_zip))
-    with ZipFile(f_zip, 'r') as z:
-        z.extractall(zip_dir)
+    # Check if the output file already exists.
+    file_name_sans_extension, _ = splitext(basename(f_zip))
+    output_file_name = file_name_sans_extension + BUFR_EXTENSION
+    output_file = join(OUTPUT_DIR, output_file_name)
 
-    # There can be multiple files in the zip.
-    txt_files = glob(join(zip_dir, "*" + SONDE_TXT_EXTENSION))
-    for txt_file in txt_files:
-        print("Processing", basename(txt_file))
-
-        # Check if the output file already exists.
-        file_name_sans_extension, _ = splitext(basename(f_zip))
-        output_file_name = file_name_sans_extension + BUFR_EXTENSION
-        output_file = join(OUTPUT_DIR, output_file_name)
-
-        if exists(output_file):
+    if exists(output_file) and not (incremental or seed_manifest):
+        if bin_output:
+            _bin_existing_output(f_zip, output_file, file_name_sans_extension)
+        else:
             print("Output file ({}) already exists, skipping..."
                   .format(basename(output_file)))
-        else:
+        return
+
+    # Read the txts straight out of the zip rather than extracting them.
+    with ZipFile(f_zip, 'r') as z:
+        # There can be multiple files in the zip.
+        txt_members = [m for m in z.namelist()
+                       if m.endswith(SONDE_TXT_EXTENSION)]
+        for txt_member in txt_members:
+            print("Processing", basename(txt_member))
+
             # Get the station code from the filename
-            station_code = basename(str(txt_file))[:11]
+            station_code = basename(txt_member)[:11]
 
             # Is the station ion the BARRA2 region?
             if not is_station_in_barra2_region(station_code):
@@ -227,11 +292,45 @@ def _process_zip(f_zip, biases):
             station_name = get_station_name_from_code(station_code)
 
             # Is there a bias for this station?
-            bias_path = None
-            for b in biases:
-                if b['station name'] == station_name:
-                    bias_path = b['path']
-                    break
+            bias = biases.get(station_name)
+            bias_path = bias['path'] if bias else None
+
+            # Compare the inputs against the manifest, the hashes are only
+            #   recalculated if a file's size or mtime has changed.
+            manifest_entry = load_manifest_entry(MANIFEST_DIR,
+                                                 file_name_sans_extension)
+            zip_details = file_details(
+                f_zip, manifest_entry["zip"] if manifest_entry else None)
+            bias_details = file_details(
+                bias_path, manifest_entry["bias"] if manifest_entry else None)
+
+            if seed_manifest:
+                # Take an existing output without an entry as converted from
+                #   the current inputs and converter, nothing is converted.
+                if manifest_entry is None and exists(output_file):
+                    save_manifest_entry(
+                        MANIFEST_DIR, file_name_sans_extension,
+                        build_manifest_entry(station_code, zip_details,
+                                             bias_details, CONVERTER_VERSION,
+                                             output_file, types_details))
+                    print("\tManifest entry seeded from the existing output.")
+                return
+
+            if incremental and is_up_to_date(manifest_entry, zip_details,
+                                             bias_details, CONVERTER_VERSION,
+                                             output_file, types_details):
+                print("\tInputs and converter unchanged, skipping.")
+
+                # Record any new mtimes so the hashes aren't recalculated
+                if zip_details != manifest_entry["zip"] or \
+                        bias_details != manifest_entry["bias"] or \
+                        types_details != manifest_entry.get("types"):
+                    manifest_entry["zip"] = zip_details
+                    manifest_entry["bias"] = bias_details
+                    manifest_entry["types"] = types_details
+                    save_manifest_entry(MANIFEST_DIR, file_name_sans_extension,
+                                        manifest_entry)
+                return
 
             # Get the metadata for that station so we know the radiosonde type
             # This has proved not feasible. Metadata is too messy and
@@ -239,64 +338,307 @@ def _process_zip(f_zip, biases):
             # Left for no for posterity. TODO: Delete?
             #something = get_station_metadata(station_code)
 
-            # We now know the filename for the raw sonde data and for
+            # We now know the raw sonde data and the filename for
             #   the bias correction (if it exists)
-            # Output to the temp directory
-            temp_output_file = join(zip_dir, output_file_name)
-            do_conversion(txt_file, bias_path, temp_output_file, TEMPLATE_BUFR)
+            # Output to a temp file alongside the output, then rename
+            #   so an interrupted conversion never leaves a partial output.
+            temp_output_file = output_file + TEMP_EXTENSION
+            try:
+                with TextIOWrapper(z.open(txt_member, 'r')) as txt_file:
+                    convert_txt_file(txt_file, bias_path,
+                                     temp_output_file, TEMPLATE_BUFR,
+                                     BINS_DIR if bin_output else None,
+                                     type_index)
+
+                # With conversion complete move to the output path
+                replace(temp_output_file, output_file)
+            finally:
+                if exists(temp_output_file):
+                    delete_file(temp_output_file)
+
+            new_entry = build_manifest_entry(station_code, zip_details,
+                                             bias_details, CONVERTER_VERSION,
+                                             output_file, types_details)
+            save_manifest_entry(MANIFEST_DIR, file_name_sans_extension,
+                                new_entry)
+            if bin_output:
+                _record_binned(file_name_sans_extension, output_file,
+                               new_entry["output"])
+
+            # If the output has changed then the 6-hourly bins need updating,
+            #   unless they've just been written directly.
+            if not bin_output and (
+                    manifest_entry is None or manifest_entry.get("output") is None
+                    or manifest_entry["output"]["sha1"] != new_entry["output"]["sha1"]):
+                with open(CHANGED_STATIONS_PATH, 'a') as f:
+                    f.write(output_file + "\n")
+
+            # There's one output per zip, any other txts are ignored.
+            break
+
+
+def _remove_stale_lock(lock_path):
+    """
+    Remove lock_path if it's older than LOCK_TIMEOUT_SEC. Returns True if
+    the lock is gone, i.e. it's worth trying to claim it again.
+
+    Two jobs can both find the same lock stale, so it's renamed to a name
+    unique to this job (only one rename succeeds) and only deleted if it's
+    the same file (inode) that was found stale. If another job has already
+    replaced it with a fresh lock, that lock is put back.
+    """
+    try:
+        lock_stat = stat(lock_path)
+    except FileNotFoundError:
+        # Released while we were looking
+        return True
+
+    if time() - lock_stat.st_mtime <= LOCK_TIMEOUT_SEC:
+        return False
 
-            # With conversion complete move to the output path
-            move(temp_output_file, output_file)
+    stale_path = "{}.{}.{}.stale".format(lock_path, gethostname(), getpid())
+    try:
+        rename(lock_path, stale_path)
+    except FileNotFoundError:
+        # Another job got there first
+        return True
 
-    # Delete everything in the temp directory
-    for f in glob(join(zip_dir, '*')):
-        delete_file(f)
+    if stat(stale_path).st_ino != lock_stat.st_ino:
+        # A fresh lock, put it back unless yet another job has claimed
+        #   the station since
+        try:
+            link(stale_path, lock_path)
+        except FileExistsError:
+            pass
+        delete_file(stale_path)
 
-    # Delete the temp directory
-    if exists(zip_dir):
-        rmdir(zip_dir)
+        return False
 
+    print("Removed stale lock:", lock_path)
+    delete_file(stale_path)
 
-# SCRIPT
-def main():
-    # Multiprocessing hax
-    # Take command line arg to indicate which process this is
-    num_processes = 100
-    process_n = int(argv[1])
+    return True
 
-    print("Running python script, {} of {}".format(process_n, num_processes))
 
-    # Build a dictionary of bias correction files with their station names.
-    biases = get_bias_correction_stations(SONDE_NC_INPUT_DIR)
+def _claim_zip(f_zip):
+    """
+    Claim f_zip for this job by creating a lock file. Returns the lock
+    file path, or None if another job has already claimed it.
+    """
+    lock_path = join(LOCK_DIR, basename(f_zip) + LOCK_EXTENSION)
+
+    for _ in range(2):
+        try:
+            fd = os_open(lock_path, O_CREAT | O_EXCL | O_WRONLY)
+        except FileExistsError:
+            # Locks left behind by a job that was killed are stale
+            #   after LOCK_TIMEOUT_SEC
+            if _remove_stale_lock(lock_path):
+                continue
+
+            return None
+
+        with fdopen(fd, 'w') as f:
+            f.write("{} {}\n".format(gethostname(), getpid()))
+
+        return lock_path
+
+    return None
+
+
+def _get_done_path(f_zip, submission):
+    return join(LOCK_DIR, submission, basename(f_zip) + DONE_EXTENSION)
+
+
+def _run_task(f_zip, biases, incremental=False, bin_output=False,
+              type_index=None, seed_manifest=False, types_details=None,
+              submission=None):
+    # Claim the zip, process it and report how long it took
+    # With a submission, stations another of its jobs has finished are
+    #   skipped rather than processed again.
+    done_path = _get_done_path(f_zip, submission) if submission else None
+    if done_path and exists(done_path):
+        return f_zip, 0, "done by another job"
+
+    lock_path = _claim_zip(f_zip)
+    if lock_path is None:
+        return f_zip, 0, "claimed by another job"
+
+    if done_path and exists(done_path):
+        # Finished and released between the check and the claim
+        delete_file(lock_path)
+        return f_zip, 0, "done by another job"
+
+    start_time = time()
+    try:
+        try:
+            _process_zip(f_zip, biases, incremental, bin_output, type_index,
+                         seed_manifest, types_details)
+            status = "done"
+        except Exception as e:
+            print("ERROR processing {}: {}".format(basename(f_zip), e))
+            status = "failed"
+
+        # Marked before the lock is released so a job that claims the
+        #   lock next sees it
+        if done_path:
+            with open(done_path, 'w') as f:
+                f.write(status + "\n")
+    finally:
+        delete_file(lock_path)
+
+    return f_zip, time() - start_time, status
 
+
+def get_sonde_zip_files(input_dir=SONDE_TXT_INPUT_DIR):
     # Raw data/txt files are compressed into single-file zips
-    sonde_txt_zip_files = glob(join(SONDE_TXT_INPUT_DIR,
+    sonde_txt_zip_files = glob(join(input_dir,
                                     "*" + SONDE_TXT_ZIP_EXTENSION))
 
     # Input dir has some other files too.
-    files_to_ignore = glob(join(SONDE_TXT_INPUT_DIR, "igra2-*.txt.zip"))
-    for f in files_to_ignore:
-        sonde_txt_zip_files.remove(f)
-
-    # Separate the list into chunks based on command line arg
-    list_len = len(sonde_txt_zip_files)
-    from math import ceil
-    chunk_size = ceil(list_len / num_processes)
-    start = process_n * chunk_size
-    end = start + chunk_size
-    sonde_txt_zip_files = sonde_txt_zip_files[start:end]
-
-    with Pool(N_CPU, maxtasksperchild=1) as pool:
-        f = partial(_process_zip, biases=biases)
-        pool.map(f, sonde_txt_zip_files)
-
-    # Delete the temp directory
-    if exists(TEMP_DIR):
-        rmdir(TEMP_DIR)
+    files_to_ignore = set(glob(join(input_dir, "igra2-*.txt.zip")))
+
+    return [f for f in sonde_txt_zip_files if f not in files_to_ignore]
+
+
+def schedule_zip_files(sonde_txt_zip_files):
+    """
+    Drop stations outside the BARRA2 region and order the rest
+    longest-first by compressed size so the big stations don't
+    leave a single worker running long after the others are done.
+    """
+    catalog = get_station_catalog(IGRA_STATION_LIST_PATH)
+
+    station_codes = [basename(f)[:11] for f in sonde_txt_zip_files]
+    in_region = catalog.region_mask(BARRA_LEFT, BARRA_RIGHT,
+                                    BARRA_BOTTOM, BARRA_TOP,
+                                    indices=catalog.get_indices(station_codes))
+
+    sonde_txt_zip_files = [f for f, keep in zip(sonde_txt_zip_files, in_region)
+                           if keep]
+
+    return sorted(sonde_txt_zip_files, key=getsize, reverse=True)
+
+
+# SCRIPT
+def parse_args():
+    parser = ArgumentParser(prog="run_conversion.py",
+                            description="Convert the IGRA sonde data in the "
+                                        "BARRA2 region to BUFR.")
+
+    parser.add_argument("--incremental",
+                        action="store_true",
+                        help="Reconvert stations whose zip, bias file or "
+                             "converter version have changed since the last "
+                             "conversion rather than skipping any station "
+                             "whose output exists. Stations whose output "
+                             "changed are listed in " + CHANGED_STATIONS_PATH
+                             + " so their 6-hourly bins can be regenerated.")
+
+    parser.add_argument("--bin",
+                        action="store_true",
+                        help="Also write each sounding directly into its "
+                             "6-hourly window file under " + BINS_DIR +
+                             ", replacing the organise_bufr.py step.")
+
+    parser.add_argument("--seed-manifest",
+                        action="store_true",
+                        help="Write manifest entries for the existing outputs "
+                             "that don't have one, taking them as converted "
+                             "from the current inputs and converter. Nothing "
+                             "is converted. Run once before the first "
+                             "--incremental run so it doesn't reconvert "
+                             "every station.")
+
+    parser.add_argument("--submission",
+                        help="An id shared by the jobs of one submission "
+                             "(see meta_submit_jobs_convert_sonde.sh). "
+                             "Stations finished by any of them are skipped "
+                             "by the rest.")
+
+    parser.add_argument("--build-bias-index",
+                        action="store_true",
+                        help="Only build/refresh the bias file index (" +
+                             BIAS_INDEX_PATH + ") then exit. Run once "
+                             "before submitting the conversion jobs.")
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    if args.build_bias_index:
+        index = update_bias_index(SONDE_NC_INPUT_DIR)
+        print("Bias index ({}) has {} files".format(BIAS_INDEX_PATH, len(index)))
+        return
+
+    # Any number of jobs can run this script at once. Each job hands
+    # out the zips dynamically to its own pool, and each zip is claimed
+    # with a lock file so only one job converts it.
+    n_cpu = int(environ.get("PBS_NCPUS", N_CPU))
+
+    print("Running python script with {} processes".format(n_cpu))
+
+    # Build a dictionary of station names with their bias correction files.
+    biases = get_bias_correction_stations(SONDE_NC_INPUT_DIR)
+
+    # The radiosonde type timeline, compiled by sonde_type_index.py
+    # It's part of every station's manifest entry so a new timeline means
+    #   --incremental reconverts them all. Hashed once here rather than
+    #   per station.
+    if exists(SONDE_TYPE_TIMELINE_PATH):
+        type_index = SondeTypeIndex(SONDE_TYPE_TIMELINE_PATH)
+        types_details = file_details(SONDE_TYPE_TIMELINE_PATH)
+        print("Loaded sonde types for {} stations".format(len(type_index.stations)))
+    else:
+        print("No sonde type timeline ({}), radiosondeType won't be set."
+              .format(SONDE_TYPE_TIMELINE_PATH))
+        type_index = None
+        types_details = None
+
+    sonde_txt_zip_files = get_sonde_zip_files()
+    n_zips = len(sonde_txt_zip_files)
+
+    sonde_txt_zip_files = schedule_zip_files(sonde_txt_zip_files)
+    print("{} of {} stations in the BARRA2 region"
+          .format(len(sonde_txt_zip_files), n_zips))
+
+    makedirs(LOCK_DIR, exist_ok=True)
+    if args.submission:
+        makedirs(join(LOCK_DIR, args.submission), exist_ok=True)
+    makedirs(MANIFEST_DIR, exist_ok=True)
+
+    start_time = time()
+    timings = []
+    with Pool(n_cpu, maxtasksperchild=1) as pool:
+        f = partial(_run_task, biases=biases, incremental=args.incremental,
+                    bin_output=args.bin, type_index=type_index,
+                    seed_manifest=args.seed_manifest,
+                    types_details=types_details,
+                    submission=args.submission)
+        for f_zip, elapsed, status in pool.imap_unordered(f, sonde_txt_zip_files):
+            print("Task {}: {}, {:.1f} MB, {:.1f}s"
+                  .format(basename(f_zip), status,
+                          getsize(f_zip) / 1e6, elapsed))
+
+            if status not in ("claimed by another job",
+                              "done by another job"):
+                timings.append((elapsed, f_zip, status))
+
+    print("Processed {} stations in {:.1f}s"
+          .format(len(timings), time() - start_time))
+
+    failed = [f_zip for _, f_zip, status in timings if status == "failed"]
+    if failed:
+        print("Failed stations:", ", ".join(basename(f) for f in failed))
+
+    print("Slowest stations:")
+    for elapsed, f_zip, status in sorted(timings, reverse=True)[:10]:
+        print("\t{}: {:.1f}s".format(basename(f_zip), elapsed))
 
     print("Script finished at", datetime.now())
 
 
 if __name__ == "__main__":
     main()
-
@@ -13,6 +13,7 @@
 
 # IMPORTS
 from math import floor
+import re
 import numpy as np
 import eccodes as ecc
 import netCDF4
@@ -29,6 +30,9 @@ class SondeObservation:
     """
 
     def __init__(self):
+        # IGRA2 Station ID, e.g. ASM00094120
+        self.station_id = None
+
         # WMO Station IDs
         self.wmo_station_block_number = None
         self.wmo_station_number = None
@@ -99,6 +103,7 @@ class SondeObservation:
         # network code that identifies the station numbering system used, and
         # the remaining eight characters contain the actual station ID"
         station_id = line[1:12]
+        self.station_id = station_id
         if station_id[2] == 'M':
             #  M = WMO identification number (last five characters of the IGRA 2 ID)
             self.wmo_station_block_number = int(station_id[6:8])
@@ -260,15 +265,66 @@ class SondeNC:
         self.n_levels = 0
         self.n_hours = 0
 
+        self.dates = None  # datetime64[D]
         self.year_month_day = None
         self.hours = None  # 2 launch times per day
         self.pressure = None
         self.air_temp = None
         self.bias = None
 
-    def read(self, file):
+    @staticmethod
+    def _days_since_to_datetime64(days, units):
+        """
+        Convert "days since Y-M-D [H:M:S]" offsets to datetime64[D] using
+        integer arithmetic rather than building cftime objects.
+
+        The date needn't be zero padded (e.g. "days since 1900-1-1 00:00:00").
+        Returns None if the units aren't days since a midnight reference,
+        in which case netCDF4.num2date should be used instead.
+        """
+        match = re.match(r"\s*days\s+since\s+(\d+)-(\d+)-(\d+)"
+                         r"(?:[ T](\d+):(\d+)(?::(\d+(?:\.\d*)?))?)?", units)
+        if match is None:
+            return None
+
+        year, month, day, hour, minute, second = match.groups()
+        if any(float(v) != 0 for v in (hour, minute, second) if v is not None):
+            return None
+
+        epoch = np.datetime64(datetime(int(year), int(month), int(day)), 'D')
+
+        return epoch + np.floor(days).astype(np.int64).astype('m8[D]')
+
+    @staticmethod
+    def _num2date_to_datetime64(days, units, calendar):
+        """
+        Convert day offsets to datetime64[D] via netCDF4.num2date.
+        """
+        t_value = netCDF4.num2date(days, units=units, calendar=calendar)
+
+        return np.array(["{:04d}-{:02d}-{:02d}".format(t.year, t.month, t.day)
+                         for t in t_value], dtype='M8[D]')
+
+    @staticmethod
+    def _datetime64_to_year_month_day(dates):
+        """
+        Convert datetime64[D] to YYYYMMDD integers.
+        """
+        months = dates.astype('M8[M]')
+        year = dates.astype('M8[Y]').astype(np.int64) + 1970
+        month = months.astype(np.int64) % 12 + 1
+        day = (dates - months).astype(np.int64) + 1
+
+        return 10000 * year + 100 * month + day
+
+    def read(self, file, year_month_days=None):
         """
         read input netcdf data
+
+        :param file: The path to the RAOBCORE netCDF file.
+        :param year_month_days: Optional collection of YYYYMMDD integers. If
+            given only the temperatures/biases for these dates are read
+            from the file.
         """
         with netCDF4.Dataset(file, 'r') as nc_in:
             # Assume latitude/longitude/altitude are correct.
@@ -282,24 +338,57 @@ class SondeNC:
             # Sondes are launched at the same time each day
             self.n_hours, self.n_levels, self.n_days = d_temperature.shape
 
-            # Convert d_days_since_1900 to an array of datetimes
-            t_units = nc_in.variables['datum'].units
-            t_calendar_type = nc_in.variables['datum'].calendar
-            t_value = netCDF4.num2date(d_days_since_1900, units=t_units, calendar=t_calendar_type)
+            # Convert the day offsets to dates and YYYYMMDD integers
+            t_units = d_days_since_1900.units
+            t_calendar_type = getattr(d_days_since_1900, 'calendar', 'standard')
+
+            days = np.array(d_days_since_1900).reshape(-1)[:self.n_days]
+            missing = days == SondeNC.MISSING
+
+            dates = None
+            if t_calendar_type in ('standard', 'gregorian', 'proleptic_gregorian'):
+                dates = SondeNC._days_since_to_datetime64(
+                    np.where(missing, 0, days), t_units)
+            if dates is None:
+                # Non-standard calendar or units, fall back to netCDF4's conversion
+                dates = SondeNC._num2date_to_datetime64(
+                    np.where(missing, 0, days), t_units, t_calendar_type)
+
+            dates[missing] = np.datetime64('NaT')
+            year_month_day = np.where(missing, SondeNC.MISSING,
+                                      SondeNC._datetime64_to_year_month_day(dates))
+
+            # Only read the slices of the cube for the requested dates
+            if year_month_days is not None:
+                day_indices = np.nonzero(
+                    np.isin(year_month_day, np.fromiter(year_month_days, dtype=np.int64)) & ~missing)[0]
+            else:
+                day_indices = slice(None)
+
+            self.dates = dates[day_indices]
+            self.year_month_day = year_month_day[day_indices]
+            self.n_days = self.year_month_day.size
 
-            # Convert to numpy arrays
-            self.year_month_day = np.array(d_days_since_1900)
-            self.hours = np.array(d_hours)
             self.pressure = 100 * np.array(d_pres).astype(int)  # hPa
-            self.air_temp = np.array(d_temperature)
-            self.bias = np.array(d_bias)
 
-            self.year_month_day.resize(self.n_days)
-            for i in range(self.n_days):
-                if self.year_month_day[i] != SondeNC.MISSING:
-                    self.year_month_day[i] = 10000 * t_value[0][i].year + \
-                                             100 * t_value[0][i].month + \
-                                             t_value[0][i].day
+            if self.n_days > 0:
+                if year_month_days is not None:
+                    # netCDF4 reads an irregular index array one index at a
+                    #  time, so read the contiguous span of the requested
+                    #  dates and pick them out in numpy.
+                    day_span = slice(day_indices[0], day_indices[-1] + 1)
+                    day_indices = day_indices - day_indices[0]
+                else:
+                    day_span = slice(None)
+
+                self.hours = np.array(d_hours[:, day_span])[:, day_indices]
+                self.air_temp = np.array(d_temperature[:, :, day_span])[:, :, day_indices]
+                self.bias = np.array(d_bias[:, :, day_span])[:, :, day_indices]
+            else:
+                # None of the requested dates are in the file
+                self.hours = np.empty((self.n_hours, 0))
+                self.air_temp = np.empty((self.n_hours, self.n_levels, 0))
+                self.bias = np.empty((self.n_hours, self.n_levels, 0))
 
 
 class SondeBUFR:
@@ -363,15 +452,30 @@ class SondeBUFR:
                                                                  nc_year_month_day_index]))
                     break
 
-    def write_bufr_message(self, file_bufr, sonde_txt_obs, sonde_nc=None):
+    def write_bufr_message(self, file_bufr, sonde_txt_obs, sonde_nc=None,
+                           sonde_type=None):
         """
         Write sonde data out to a .bufr file for barra2.
 
-        :param file_bufr: The file path to the .bufr file to be written to.
+        :param file_bufr: The open .bufr file to be written to.
         :param sonde_txt_obs: A SondeTXT containing the raw sonde data from IGRA.
         :param sonde_nc: An optional SondeNC file to set the bias correction (leave as None if not available).
+        :param sonde_type: An optional WMO radiosonde type (code table 002011) to set.
         :return:
         """
+        file_bufr.write(self.encode_bufr_message(sonde_txt_obs, sonde_nc,
+                                                 sonde_type))
+
+    def encode_bufr_message(self, sonde_txt_obs, sonde_nc=None,
+                            sonde_type=None):
+        """
+        Encode sonde data as a BUFR message for barra2.
+
+        :param sonde_txt_obs: A SondeTXT containing the raw sonde data from IGRA.
+        :param sonde_nc: An optional SondeNC file to set the bias correction (leave as None if not available).
+        :param sonde_type: An optional WMO radiosonde type (code table 002011) to set.
+        :return: The encoded message as bytes.
+        """
         ecc.codes_set(self.output_bufr, 'unpack', 1)
 
         century = floor(sonde_txt_obs.date_time.year / 100)
@@ -416,7 +520,8 @@ class SondeBUFR:
             ecc.codes_set(self.output_bufr, self.wind_direction[i], sonde_txt_obs.wind_direction[i])
             ecc.codes_set(self.output_bufr, self.wind_speed[i], sonde_txt_obs.wind_speed[i])
 
-        # ecc.codes_set(self.b_temp, 'radiosondeType', t.sonde_type)
+        if sonde_type is not None:
+            ecc.codes_set(self.output_bufr, 'radiosondeType', int(sonde_type))
 
         # Check if bias-corrected temperature is available
         if sonde_nc:
@@ -442,7 +547,7 @@ class SondeBUFR:
 
         # Avoid unpacking self.output_bufr the next time
         ecc.codes_set(self.output_bufr, 'pack', 1)
-        ecc.codes_write(self.output_bufr, file_bufr)
+        return ecc.codes_get_message(self.output_bufr)
 
     def close(self):
         ecc.codes_release(self.output_bufr)
@@ -1,24 +1,35 @@
 # This script is intended to be used to check the "vital statistics" of a
 # sonde bufr file to allow comparison between supposedly identical files.
 #
+# The converted and production files for each cycle are read once, in
+# place, into columns. The cycles are summarised in parallel into a single
+# report with a row per cycle and source; plotting is a separate step.
+#
+# Usage:
+#   python3 sonde_bufr_check.py -s 19780101T0000 -e 19780131T1800 -o report.csv
+#   python3 sonde_bufr_check.py --plot report.csv
+#
 # Joshua Torrance
 
-from collections.abc import Iterable
-from datetime import datetime
 # IMPORTS
+from argparse import ArgumentParser, ArgumentTypeError
+from collections.abc import Iterable
+from datetime import datetime, timedelta
 from glob import glob
-from os import remove
-from os.path import exists, basename
-from shutil import copyfile
-from subprocess import run
+from multiprocessing import Pool
+from os import environ
 from sys import path
 
 from matplotlib import pyplot as plt
-from numpy import array, concatenate
+from numpy import array, asarray, concatenate, nan, isnan, unique, \
+    nanmean, nanstd, nanmin, nanmax, count_nonzero, full, errstate
+from pandas import DataFrame, read_csv
 
 # Import custom modules
 path.insert(1, "/g/data/hd50/jt4085/BARRA2/util/bufr")
 from eccodes_wrapper import BufrFile
+from station_catalog import get_station_catalog
+from sonde_profiles import MISSING_DOUBLE, MISSING_LONG
 
 # PARAMETERS
 # Barra region
@@ -28,11 +39,9 @@ BARRA_BOTTOM = -60.00
 BARRA_TOP = 15.00
 barra_filter = (BARRA_LEFT, BARRA_RIGHT, BARRA_BOTTOM, BARRA_TOP)
 
+COMMANDLINE_DT_FORMAT = "%Y%m%dT%H%M"
+CYCLE_HOURS = 6
 
-YEAR = 2007
-MONTH = 1
-DAY = 21
-HOUR = 18
 INPUT_DIR1 = "/scratch/hd50/jt4085/sonde/data-bufr-bins"
 INPUT_FILE_PATH1 = "{input_dir}/{year}/{month:02}/{year}{month:02}{day:02}T{hour:02}00Z/*.bufr"
 #INPUT_FILE_PATH = "/scratch/hd50/jt4085/sonde/data-bufr/ZZXUAICE019-data.bufr"
@@ -40,226 +49,283 @@ INPUT_FILE_PATH1 = "{input_dir}/{year}/{month:02}/{year}{month:02}{day:02}T{hour
 INPUT_DIR2 = "/g/data/hd50/barra2/data/obs/production"
 INPUT_FILE_PATH2 = "{input_dir}/{year}/{month:02}/{year}{month:02}{day:02}T{hour:02}00Z/bufr/sonde/TEMP_*.bufr"
 
-STATION_LIST_PATH = "/g/data/hd50/barra2/data/obs/igra/doc/igra2-station-list.txt"
-
-TEMP_FILE_DIR = "/scratch/hd50/jt4085/tmp"
-TEMP_FILE_PATH = TEMP_FILE_DIR + "/temporary.file"
-
-
-# METHODS
-def get_obs_count(filepath, geo_filter=None):
-    # geo_filter should be (left, right, bottom, top)
-    obs_count = 0
-    with BufrFile(filepath) as bufr:
-        for msg in bufr.get_messages():
-            if geo_filter:
-                lat, lon = msg.get_locations()
-                if lat=="MISSING" or lon=="MISSING":
-                    # Something has gone awry
-                    print("Missing lat or lon for:", filepath)
-                    continue
-
-                left, right, bottom, top = geo_filter
-
-                if not (
-                    bottom < lat < top and \
-                    (left < right and (left < lon < right) or \
-                     left > right and (left < lon or lon < right))):
-                    # ^ Watch out for left/right looping
-                    # Outside filter, skip
-                    continue
-
-            obs_count += msg.get_obs_count()
-
-    return obs_count
+SOURCES = {"Converted": (INPUT_DIR1, INPUT_FILE_PATH1),
+           "Production": (INPUT_DIR2, INPUT_FILE_PATH2)}
 
+STATION_LIST_PATH = "/g/data/hd50/barra2/data/obs/igra/doc/igra2-station-list.txt"
 
-def get_locations(filepath):
-    latitude = []
-    longitude = []
-    with BufrFile(filepath) as bufr:
-        for msg in bufr.get_messages():
-            lat, lon = msg.get_locations()
+# Variables to summarise
+VARIABLES = ["pressure", "airTemperature", "dewpointTemperature",
+             "windDirection", "windSpeed"]
 
-            latitude.append(lat)
-            longitude.append(lon)
+# Multiprocessing, the number of processes is taken from PBS_NCPUS
+#  otherwise N_CPU
+N_CPU = 1
 
-    latitude = [lat if lat != "MISSING" else float('NaN')
-                for lat in latitude]
-    longitude = [lon if lon != "MISSING" else float('NaN')
-                 for lon in longitude]
 
-    return array(latitude), array(longitude)
+# METHODS
+def _to_float_array(values):
+    # Convert a BUFR value or array to floats with NaN for missing
+    if isinstance(values, str) or values is None:
+        # "MISSING"
+        return array([nan])
+    elif not isinstance(values, Iterable):
+        values = [values]
 
+    values = asarray(values, dtype=float)
+    values[(values == MISSING_DOUBLE) | (values == MISSING_LONG)] = nan
 
-def grep(file_path, regex):
-    # Just use grep itself.
-    ret = run(["grep", regex, file_path], capture_output=True)
+    return values
 
-    # Decode from bytes string and return
-    return ret.stdout.decode("utf-8")
 
+def region_mask(lat, lon, geo_filter):
+    # geo_filter should be (left, right, bottom, top)
+    left, right, bottom, top = geo_filter
 
-def get_station_location(station_name):
-    station_line = grep(STATION_LIST_PATH, station_name)    
+    with errstate(invalid="ignore"):
+        in_lat = (bottom < lat) & (lat < top)
+        if left < right:
+            in_lon = (left < lon) & (lon < right)
+        else:
+            # Watch out for left/right looping
+            in_lon = (left < lon) | (lon < right)
 
-    lat = float(station_line[12:20])
-    lon = float(station_line[21:30])
+    return in_lat & in_lon
 
-    # Check if lat/lon are mobile stations
-    if lat == -98.8888:
-        lat = None
-    if lon == -998.8888:
-        lon = None
 
-    return lat, lon
+def read_file_columns(filepath, variables=VARIABLES):
+    """
+    Read the location, subset count and variables of every message in a
+    file in one pass.
 
+    Returns a dictionary of arrays: per message "latitude", "longitude" and
+    "subsets", and for each variable its values, with "<variable> message"
+    giving the index of the message each value came from.
+    """
+    latitude = []
+    longitude = []
+    subsets = []
+    values = {v: [] for v in variables}
+    value_messages = {v: [] for v in variables}
 
-def get_attribute_number_array(file_path, key):
-    arr = None
-    with BufrFile(file_path) as bufr:
-        for msg in bufr.get_messages():
-            values = msg.get_value(key)
+    with BufrFile(filepath) as bufr:
+        for i, msg in enumerate(bufr.get_messages()):
+            lat, lon = msg.get_locations()
 
-            if not isinstance(values, Iterable):
-                values = [values]
-            elif values == "MISSING":
-                values = [float("NaN")]
+            # One location per message is enough for sondes
+            latitude.append(_to_float_array(lat)[0])
+            longitude.append(_to_float_array(lon)[0])
+            subsets.append(msg.get_obs_count())
 
-            if arr is not None:
-                arr = concatenate((arr, values))
-            else:
-                arr = values
+            for v in variables:
+                try:
+                    v_values = _to_float_array(msg.get_value(v))
+                except ValueError:
+                    # Not in this message
+                    continue
 
-    return arr
+                values[v].append(v_values)
+                value_messages[v].append(full(v_values.shape, i))
 
+    columns = {"latitude": array(latitude, dtype=float),
+               "longitude": array(longitude, dtype=float),
+               "subsets": array(subsets, dtype=int)}
 
-# SCRIPT
-def main():
-    dts = []
-    prod_obs_count = []
-    converted_obs_count = []
-#    for y in range(1978, 1984):
-    for y in [1978]:
-        for m in range(1, 2):
-            for d in range(1, 31):
-                for h in [0, 6, 12, 18]:
-                    dts.append(datetime(year=y, month=m, day=d, hour=h))
-
-                    input_1 = INPUT_FILE_PATH1.format(
-                        input_dir=INPUT_DIR1, year=y, month=m,
-                        day=d, hour=h)
-
-                    input_2 = INPUT_FILE_PATH2.format(
-                        input_dir=INPUT_DIR2, year=y, month=m,
-                        day=d, hour=h)
-
-                    print(input_1)
-                    print(input_2)
-
-                    print()
-                    obs_count = 0
-                    for f in glob(input_2):
-                        print(f)
-                        print(basename(f))
+    for v in variables:
+        columns[v] = concatenate(values[v]) if values[v] else array([])
+        columns[v + " message"] = concatenate(value_messages[v]) \
+            if value_messages[v] else array([], dtype=int)
 
-                        # Make a copy of the file to interrogate
-                        copyfile(f, TEMP_FILE_PATH)
-                        f = TEMP_FILE_PATH
+    return columns
 
-                        print("\tGetting lat and lon...", end="")
-                        lat, lon = get_locations(f)
-                        lon = [l + 360 if l<0 else l for l in lon]
-                        plt.scatter(lon, lat, color="C0", marker="x",
-                                    label="Production")
-                        print("done.")
 
-                        obs_c = get_obs_count(f, geo_filter=(barra_filter))
-                        obs_count += obs_c
+def get_obs_count(filepath, geo_filter=None):
+    # geo_filter should be (left, right, bottom, top)
+    columns = read_file_columns(filepath, variables=[])
 
-                        print("\tObs Count:", obs_c)
+    if geo_filter:
+        mask = region_mask(columns["latitude"], columns["longitude"], geo_filter)
+        return int(columns["subsets"][mask].sum())
 
+    return int(columns["subsets"].sum())
 
-#                        try:
-#                            air_temp = get_attribute_number_array(f, "airTemperature")
-#                        except ValueError as e:
-                            # This is failing sometimes.
-                            # TODO: Figure out why I can't access attributes
-                            #  sometimes.
-                            # For now fill the array with NaN
-#                            print("\tFailed to get air_temp:", e)
-#                            air_temp = full(lat.shape, float("nan"))
 
-#                        print("air_temp")
-#                        print(air_temp)
-#                        print("\tMean:", nanmean(air_temp))
-#                        print("\tStd:", nanstd(air_temp))
-#                        print("\tMin:", nanmin(air_temp))
-#                        print("\tMax:", nanmax(air_temp))
+def get_locations(filepath):
+    columns = read_file_columns(filepath, variables=[])
 
-                    prod_obs_count.append(obs_count)
+    return columns["latitude"], columns["longitude"]
 
-                    print()
-                    obs_count = 0
-                    for f in glob(input_1):
-                        print(basename(f))
 
-                        print("\tGetting lat and lon...", end="")
-                        lat, lon = get_locations(f)
+def get_station_location(station_name):
+    # lat/lon are None for mobile stations
+    return get_station_catalog(STATION_LIST_PATH).get_location(station_name)
 
-                        lon = [l + 360 if l<0 else l for l in lon]
 
-                        if lon is not None and lat is not None:
-                            plt.scatter(lon, lat, marker='+', color="C1",
-                                        label="Converted")
+def get_attribute_number_array(file_path, key):
+    return read_file_columns(file_path, variables=[key])[key]
+
+
+def summarise_cycle(cycle, source, geo_filter=barra_filter):
+    """
+    Summarise the files for one cycle and source as a dictionary (a row of
+    the report).
+    """
+    input_dir, input_file_path = SOURCES[source]
+    files = sorted(glob(input_file_path.format(
+        input_dir=input_dir, year=cycle.year, month=cycle.month,
+        day=cycle.day, hour=cycle.hour)))
+
+    row = {"Datetime": cycle, "Source": source, "Files": len(files)}
+
+    all_columns = []
+    for f in files:
+        try:
+            all_columns.append(read_file_columns(f))
+        except Exception as e:
+            print("Failed to read {}: {}".format(f, e))
+
+    if all_columns:
+        latitude = concatenate([c["latitude"] for c in all_columns])
+        longitude = concatenate([c["longitude"] for c in all_columns])
+        subsets = concatenate([c["subsets"] for c in all_columns])
+    else:
+        latitude = longitude = array([])
+        subsets = array([], dtype=int)
+
+    in_region = region_mask(latitude, longitude, geo_filter)
+
+    row["Messages"] = len(subsets)
+    row["Missing Location"] = int(count_nonzero(isnan(latitude) | isnan(longitude)))
+    row["Obs Count"] = int(subsets[in_region].sum())
+
+    # Spatial coverage of the messages in the region
+    region_lat = latitude[in_region]
+    region_lon = longitude[in_region] % 360
+    row["Locations"] = len(unique(array([region_lat, region_lon]).round(2), axis=1).T) \
+        if len(region_lat) else 0
+    for name, values in (("Latitude", region_lat), ("Longitude", region_lon)):
+        row[name + " Min"] = nanmin(values) if len(values) else nan
+        row[name + " Max"] = nanmax(values) if len(values) else nan
+
+    # Per variable stats for the messages in the region
+    for v in VARIABLES:
+        values = []
+        for c in all_columns:
+            mask = region_mask(c["latitude"], c["longitude"], geo_filter)
+            values.append(c[v][mask[c[v + " message"]]])
+        values = concatenate(values) if values else array([])
+
+        row[v + " Count"] = int(count_nonzero(~isnan(values)))
+        if row[v + " Count"] > 0:
+            row[v + " Mean"] = nanmean(values)
+            row[v + " Std"] = nanstd(values)
+            row[v + " Min"] = nanmin(values)
+            row[v + " Max"] = nanmax(values)
+        else:
+            row[v + " Mean"] = row[v + " Std"] = nan
+            row[v + " Min"] = row[v + " Max"] = nan
+
+    return row
+
+
+def _summarise_cycle(args):
+    return summarise_cycle(*args)
+
+
+def build_report(start_dt, end_dt, n_processes=N_CPU):
+    """
+    Summarise every cycle from start_dt to end_dt (inclusive) for both
+    sources, in parallel. Returns a DataFrame with a row per cycle and source.
+    """
+    tasks = []
+    cycle = start_dt
+    while cycle <= end_dt:
+        for source in SOURCES:
+            tasks.append((cycle, source))
+        cycle += timedelta(hours=CYCLE_HOURS)
+
+    with Pool(n_processes) as pool:
+        rows = pool.map(_summarise_cycle, tasks, chunksize=4)
+
+    return DataFrame(rows).sort_values(by=["Datetime", "Source"]) \
+        .reset_index(drop=True)
+
+
+def plot_report(report):
+    """
+    Plot a report from build_report, or read from its CSV.
+    """
+    if isinstance(report, str):
+        report = read_csv(report, parse_dates=["Datetime"])
+
+    plt.figure("Observation Count")
+    for i, source in enumerate(SOURCES):
+        df = report[report["Source"] == source]
+        plt.plot(df["Datetime"], df["Obs Count"], color="C{}".format(i),
+                 label=source)
+    plt.xlabel("Datetime")
+    plt.ylabel("Observation Count")
+    plt.legend()
+
+    plt.figure("Variable Means")
+    for j, v in enumerate(VARIABLES):
+        plt.subplot(len(VARIABLES), 1, j + 1)
+        for i, source in enumerate(SOURCES):
+            df = report[report["Source"] == source]
+            plt.plot(df["Datetime"], df[v + " Mean"], color="C{}".format(i),
+                     label=source)
+        plt.ylabel(v)
+    plt.xlabel("Datetime")
+    plt.legend(loc="lower right")
 
-                        print("done.")
+    plt.show()
 
-                        obs_c = get_obs_count(f, geo_filter=barra_filter)
-                        obs_count += obs_c
 
-                        print("\tObs Count:", obs_c)
+# SCRIPT
+def parse_args():
+    def valid_date(s):
+        try:
+            return datetime.strptime(s, COMMANDLINE_DT_FORMAT)
+        except ValueError:
+            msg = "not a valid date: {0!r}".format(s)
+            raise ArgumentTypeError(msg)
 
-                    converted_obs_count.append(obs_count)
+    parser = ArgumentParser(prog="sonde_bufr_check.py",
+                            description="Compare the converted sonde BUFRs "
+                                        "with the production BUFRs.")
 
-        if exists(TEMP_FILE_PATH):
-            remove(TEMP_FILE_PATH)
+    parser.add_argument("-s", "--start", type=valid_date,
+                        help="First cycle, use the format " + COMMANDLINE_DT_FORMAT)
+    parser.add_argument("-e", "--end", type=valid_date,
+                        help="Last cycle, use the format " + COMMANDLINE_DT_FORMAT)
+    parser.add_argument("-o", "--output",
+                        help="Path to write the report CSV to.")
+    parser.add_argument("--plot",
+                        help="Plot a report CSV rather than building one.")
 
-    #    plt.xlim((-180, 180))
-    #    plt.xlim((0, 360))
-    #    plt.ylim((-90, 90))
-        plt.xlim((BARRA_LEFT-5, BARRA_RIGHT+360+5))
-        plt.ylim((BARRA_BOTTOM-5, BARRA_TOP+5))
+    args = parser.parse_args()
 
-        plt.axhline(BARRA_BOTTOM, linestyle='-', color='r')
-        plt.axhline(BARRA_TOP, linestyle='-', color='r')
-        plt.axvline(BARRA_LEFT, linestyle='-', color='r')
-        plt.axvline(BARRA_RIGHT, linestyle='-', color='r')
-        plt.axvline(BARRA_RIGHT+360, linestyle='-', color='r')
+    if args.plot is None and (args.start is None or args.end is None
+                              or args.output is None):
+        parser.error("--start, --end and --output are required to build a report")
 
-        plt.title(str(y))
-        plt.xlabel("Longitude (degrees)")
-        plt.ylabel("Latitude (degrees)")
+    return args
 
-        # Dedup labels
-        handles, labels = plt.gca().get_legend_handles_labels()
-        by_label = dict(zip(labels, handles))
-        plt.legend(by_label.values(), by_label.keys(), loc='lower right')
 
-        plt.figure()
-        plt.plot(dts, converted_obs_count, color="C1", label="Converted")
-        plt.plot(dts, prod_obs_count, color="C0", label="Production")
+def main():
+    args = parse_args()
 
-        print("Datetime, Converted, Production")
-        for dt, con, pro in zip(dts, converted_obs_count, prod_obs_count):
-            print(", ".join([dt.strftime("%Y%m%dT%H%M"), str(con), str(pro)]))
+    if args.plot:
+        plot_report(args.plot)
+        return
 
-        plt.xlabel("Datetime")
-        plt.ylabel("Observation Count")
+    n_cpu = int(environ.get("PBS_NCPUS", N_CPU))
+    report = build_report(args.start, args.end, n_cpu)
 
-        plt.legend()
+    report.to_csv(args.output, index=False)
 
-    plt.show()
+    print(report[["Datetime", "Source", "Files", "Obs Count"]].to_string(index=False))
+    print("Report written to", args.output)
 
 
 if __name__ == "__main__":
@@ -20,8 +20,18 @@
 
 # IMPORTS
 from argparse import ArgumentParser
+from contextlib import ExitStack
 from logging import basicConfig as loggingConfig, info
 from sonde import SondeTXT, SondeNC, SondeBUFR
+from bufr_windows import WindowedBufrWriter
+from sonde_type_index import SondeTypeIndex
+from sonde_type_matcher import MISSING_SONDE_TYPE
+
+
+# PARAMETERS
+# Increment this whenever a change alters the BUFR output so that
+# run_conversion.py --incremental knows to reconvert every station.
+CONVERTER_VERSION = 3
 
 
 # METHODS
@@ -51,6 +61,16 @@ def parse_args():
                         required=True,
                         help="File path to the desired output file.")
 
+    parser.add_argument("--bins",
+                        required=False,
+                        help="Optional directory to also write each sounding "
+                             "into its 6-hourly window file.")
+
+    parser.add_argument("--types",
+                        required=False,
+                        help="Optional sonde type timeline CSV (see "
+                             "sonde_type_index.py) to set the radiosondeType from.")
+
     parser.add_argument("-v", "--verbose",
                         required=False,
                         action="store_true",
@@ -70,37 +90,111 @@ def main():
     path_input_nc = args.bias
     path_template_bufr = args.template
     path_output_bufr = args.output
+    bins_dir = args.bins
+    type_index = SondeTypeIndex(args.types) if args.types else None
 
     info("Input file: {}".format(path_input_txt))
     info("Bias file: {}".format(path_input_nc))
     info("BUFR Template file: {}".format(path_template_bufr))
     info("Output file: {}".format(path_output_bufr))
+    info("Bins directory: {}".format(bins_dir))
 
-    do_conversion(path_input_nc, path_input_txt, path_output_bufr, path_template_bufr)
+    do_conversion(path_input_txt, path_input_nc, path_output_bufr, path_template_bufr,
+                  bins_dir, type_index)
 
 
-def do_conversion(path_input_txt, path_input_nc, path_output_bufr, path_template_bufr):
+def do_conversion(path_input_txt, path_input_nc, path_output_bufr, path_template_bufr,
+                  bins_dir=None, type_index=None):
     """
     :param path_input_txt: The input .txt file for the raw sonde data.
     :param path_input_nc: The optional input .nc file for the bias correction.
-    :param path_output_bufr: The output bufr file
+    :param path_output_bufr: The output bufr file, may be None if bins_dir is given.
+    :param path_template_bufr: The template bufr file.
+    :param bins_dir: Optional directory to also write each sounding into its
+        6-hourly window file, YYYY/MM/YYYYMMDDTHH00Z/<station>-<YYYYMMDDHH00>.bufr
+    :param type_index: An optional SondeTypeIndex to set the radiosondeType from.
+    :return:
+    """
+    with open(path_input_txt, 'r') as file_txt:
+        convert_txt_file(file_txt, path_input_nc, path_output_bufr, path_template_bufr,
+                         bins_dir, type_index)
+
+
+def get_sonde_type(type_index, obs):
+    """
+    The radiosonde type for an observation, MISSING_SONDE_TYPE if unknown.
+    """
+    # Only WMO stations can be matched.
+    if obs.wmo_station_block_number is None or obs.wmo_station_number is None:
+        return MISSING_SONDE_TYPE
+
+    sonde_type = type_index.get_type(obs.wmo_station_number,
+                                     obs.wmo_station_block_number,
+                                     None,
+                                     obs.date_time.replace(tzinfo=None))
+
+    if sonde_type is None or sonde_type == "MISSING":
+        return MISSING_SONDE_TYPE
+
+    return sonde_type
+
+
+def convert_txt_file(file_txt, path_input_nc, path_output_bufr, path_template_bufr,
+                     bins_dir=None, type_index=None):
+    """
+    As do_conversion but reads the raw sonde data from an open text file,
+    e.g. a member of the IGRA zip opened with ZipFile.open.
+
+    :param file_txt: The open text file for the raw sonde data.
+    :param path_input_nc: The optional input .nc file for the bias correction.
+    :param path_output_bufr: The output bufr file, may be None if bins_dir is given.
     :param path_template_bufr: The template bufr file.
+    :param bins_dir: Optional directory to also write each sounding into its
+        6-hourly window file.
+    :param type_index: An optional SondeTypeIndex to set the radiosondeType from.
     :return:
     """
+    sonde_txt = SondeTXT()
+    sonde_txt.read(file_txt)
+
     if path_input_nc:
-        # Load the data in the .nc file
+        # Load the data in the .nc file, only for the dates in the txt
+        year_month_days = {10000 * obs.date_time.year +
+                           100 * obs.date_time.month +
+                           obs.date_time.day
+                           for obs in sonde_txt.observations}
+
         sonde_nc = SondeNC()
-        sonde_nc.read(path_input_nc)
+        sonde_nc.read(path_input_nc, year_month_days)
     else:
         sonde_nc = None
-    sonde_txt = SondeTXT()
-    with open(path_input_txt, 'r') as file_txt:
-        sonde_txt.read(file_txt)
-    with open(path_output_bufr, 'wb') as file_bufr:
+
+    if len(sonde_txt.observations) == 0:
+        station_id = None
+    else:
+        station_id = sonde_txt.observations[0].station_id
+
+    with ExitStack() as stack:
+        file_bufr = None
+        if path_output_bufr:
+            file_bufr = stack.enter_context(open(path_output_bufr, 'wb'))
+
+        bins = None
+        if bins_dir and station_id:
+            bins = stack.enter_context(WindowedBufrWriter(
+                bins_dir, station_id + "-{window:%Y%m%d%H00}.bufr"))
+
         for obs in sonde_txt.observations:
             sonde_bufr = SondeBUFR(path_template_bufr, obs.n_levels)
 
-            sonde_bufr.write_bufr_message(file_bufr, obs, sonde_nc)
+            sonde_type = get_sonde_type(type_index, obs) if type_index else None
+
+            message = sonde_bufr.encode_bufr_message(obs, sonde_nc, sonde_type)
+
+            if file_bufr:
+                file_bufr.write(message)
+            if bins:
+                bins.write(obs.date_time, message)
 
             sonde_bufr.close()
 
@@ -0,0 +1,200 @@
+# Bulk extraction of sonde profiles from BUFR files.
+#
+# Every level of every sounding in a file is read with one array key access
+# per variable per message (e.g. "airTemperature" rather than
+# "#1#airTemperature", "#2#airTemperature", ...) and stored as a ragged
+# structure: a flat array of values per variable plus offsets marking where
+# each sounding starts. Missing values are NaN.
+#
+# Each message is taken to hold a single sounding, as written by sonde.py
+# and in the production TEMP files.
+#
+# Usage:
+#   profiles = read_sonde_profiles("ASM00094120-201904221200.bufr")
+#   air_temp = profiles.get_profile("airTemperature", 0)
+#
+# Author: Joshua Torrance
+
+# IMPORTS
+from glob import glob
+
+import eccodes as ecc
+from numpy import array, asarray, concatenate, cumsum, nan, isnan, \
+    zeros, repeat, arange
+
+from sys import path
+path.insert(1, "/g/data/hd50/jt4085/BARRA2/util/bufr")
+from eccodes_wrapper import BufrFile
+
+
+# PARAMETERS
+PROFILE_KEYS = ["pressure", "nonCoordinateGeopotentialHeight",
+                "airTemperature", "dewpointTemperature",
+                "windDirection", "windSpeed"]
+
+# ecCodes missing values
+MISSING_DOUBLE = -1e100
+MISSING_LONG = 2147483647
+
+
+# FUNCTIONS
+def _get_key_array(message_id, key):
+    # All the values of key in the message as floats, NaN for missing
+    if not ecc.codes_is_defined(message_id, key):
+        return array([])
+
+    values = asarray(ecc.codes_get_array(message_id, key), dtype=float)
+    values[(values == MISSING_DOUBLE) | (values == MISSING_LONG)] = nan
+
+    return values
+
+
+def _get_key_scalar(message_id, key):
+    # The first value of key in the message as a float, NaN for missing
+    values = _get_key_array(message_id, key)
+
+    return values[0] if len(values) else nan
+
+
+# CLASSES
+class SondeProfiles:
+    """
+    All the levels of a set of soundings.
+
+    Per sounding: station_ids, latitude, longitude and datetimes.
+    Per variable: values[key], the levels of every sounding end to end, and
+    offsets[key], where sounding i is values[key][offsets[key][i]:
+    offsets[key][i + 1]]. Offsets are per variable since the production
+    files don't always report every variable at every level.
+    """
+
+    def __init__(self, keys, station_ids, latitude, longitude, datetimes,
+                 values, offsets):
+        self.keys = keys
+        self.station_ids = station_ids
+        self.latitude = latitude
+        self.longitude = longitude
+        self.datetimes = datetimes
+        self.values = values
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.latitude)
+
+    def get_profile(self, key, i):
+        """
+        Return the levels of key for sounding i.
+        """
+        offsets = self.offsets[key]
+
+        return self.values[key][offsets[i]:offsets[i + 1]]
+
+    def get_level_counts(self, key):
+        return self.offsets[key][1:] - self.offsets[key][:-1]
+
+    def get_sounding_index(self, key):
+        """
+        Return the sounding index of every value of key, useful for
+        broadcasting per sounding details (e.g. latitude) onto the levels.
+        """
+        return repeat(arange(len(self)), self.get_level_counts(key))
+
+    def select(self, mask):
+        """
+        Return a new SondeProfiles with only the soundings where mask is True.
+        """
+        mask = asarray(mask, dtype=bool)
+
+        values = {}
+        offsets = {}
+        for key in self.keys:
+            counts = self.get_level_counts(key)
+            values[key] = self.values[key][repeat(mask, counts)]
+            offsets[key] = concatenate(([0], cumsum(counts[mask])))
+
+        return SondeProfiles(self.keys,
+                             self.station_ids[mask],
+                             self.latitude[mask],
+                             self.longitude[mask],
+                             self.datetimes[mask],
+                             values, offsets)
+
+    @staticmethod
+    def concatenate(profiles_list, keys=PROFILE_KEYS):
+        """
+        Combine several SondeProfiles, e.g. from every file in a cycle.
+        """
+        if not profiles_list:
+            return SondeProfiles(keys, array([], dtype=object), array([]),
+                                 array([]), array([], dtype='M8[s]'),
+                                 {k: array([]) for k in keys},
+                                 {k: zeros(1, dtype=int) for k in keys})
+
+        values = {}
+        offsets = {}
+        for key in keys:
+            values[key] = concatenate([p.values[key] for p in profiles_list])
+            counts = concatenate([p.get_level_counts(key) for p in profiles_list])
+            offsets[key] = concatenate(([0], cumsum(counts)))
+
+        return SondeProfiles(keys,
+                             concatenate([p.station_ids for p in profiles_list]),
+                             concatenate([p.latitude for p in profiles_list]),
+                             concatenate([p.longitude for p in profiles_list]),
+                             concatenate([p.datetimes for p in profiles_list]),
+                             values, offsets)
+
+
+def read_sonde_profiles(filepath, keys=PROFILE_KEYS):
+    """
+    Read every sounding in a BUFR file into a SondeProfiles.
+    """
+    station_ids = []
+    latitude = []
+    longitude = []
+    datetimes = []
+    values = {k: [] for k in keys}
+    counts = {k: [] for k in keys}
+
+    with BufrFile(filepath) as bufr:
+        for msg in bufr.get_messages():
+            message_id = msg.message_id
+
+            block = _get_key_scalar(message_id, "blockNumber")
+            station = _get_key_scalar(message_id, "stationNumber")
+            station_ids.append(None if isnan(block) or isnan(station) else
+                               "{:02.0f}{:03.0f}".format(block, station))
+
+            latitude.append(_get_key_scalar(message_id, "latitude"))
+            longitude.append(_get_key_scalar(message_id, "longitude"))
+
+            date_time = [_get_key_scalar(message_id, k)
+                         for k in ("year", "month", "day", "hour", "minute")]
+            if isnan(date_time[-1]):
+                # Missing minutes are taken as on the hour
+                date_time[-1] = 0
+            datetimes.append("NaT" if any(isnan(date_time)) else
+                             "{:04.0f}-{:02.0f}-{:02.0f}T{:02.0f}:{:02.0f}"
+                             .format(*date_time))
+
+            for key in keys:
+                key_values = _get_key_array(message_id, key)
+                values[key].append(key_values)
+                counts[key].append(len(key_values))
+
+    return SondeProfiles(
+        keys,
+        array(station_ids, dtype=object),
+        array(latitude, dtype=float),
+        array(longitude, dtype=float),
+        array(datetimes, dtype='M8[s]'),
+        {k: concatenate(values[k]) if values[k] else array([]) for k in keys},
+        {k: concatenate(([0], cumsum(counts[k], dtype=int))) for k in keys})
+
+
+def read_sonde_profiles_glob(pattern, keys=PROFILE_KEYS):
+    """
+    Read every sounding in the files matching pattern, e.g. a cycle's bins.
+    """
+    return SondeProfiles.concatenate(
+        [read_sonde_profiles(f, keys) for f in sorted(glob(pattern))], keys)
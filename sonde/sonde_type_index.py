@@ -0,0 +1,162 @@
+# Radiosonde type lookups by station and time.
+#
+# build_type_map.py scrapes the radiosonde types from the old production
+# BUFRs into monthly CSVs. This module indexes those CSVs by station so the
+# type at a given time is a binary search. Running it as a script compiles
+# all of the monthly CSVs into a single compact timeline, keeping only the
+# first row of each station's months and the rows where its type changes,
+# for use during conversion.
+#
+# As with the monthly CSVs, a type is only given for a month the station
+# was seen in by the production BUFRs, it isn't carried into months it
+# wasn't.
+#
+# Usage:
+#   python3 sonde_type_index.py
+#
+# Author: Joshua Torrance
+
+# IMPORTS
+from bisect import bisect_right
+from glob import glob
+from math import isnan
+from os import replace
+from os.path import join
+
+from pandas import read_csv, concat, DataFrame
+
+
+# PARAMETERS
+SONDE_TYPE_DIR = "/scratch/hd50/jt4085/sonde/sonde_types"
+SONDE_TYPE_CSV_GLOB = "*_sonde_types.csv"
+
+# The compiled timeline of every station's type changes
+SONDE_TYPE_TIMELINE_PATH = join(SONDE_TYPE_DIR, "sonde_type_timeline.csv")
+
+KEY_COLUMNS = ["WMO Block Number", "WMO Station Number",
+               "Ship or Mobile Station Identifier"]
+TIMELINE_COLUMNS = KEY_COLUMNS + ["Datetime", "Radiosonde Type"]
+
+
+# CLASSES
+class SondeTypeIndex:
+    """
+    The radiosonde types from one or more sonde type CSVs (see
+    build_type_map.py), indexed by station.
+
+    Each station, i.e. (WMO block number, WMO station number, ship or
+    mobile station identifier), holds its type change datetimes in sorted
+    order so the type at a given time is a binary search.
+    """
+
+    def __init__(self, type_csv_files):
+        # (block, station, ship): ([datetimes], [types])
+        self.stations = {}
+
+        if isinstance(type_csv_files, str):
+            type_csv_files = [type_csv_files]
+
+        csv = concat([read_csv(f, parse_dates=["Datetime"])
+                      for f in type_csv_files],
+                     ignore_index=True)
+
+        # Stable sort so rows with equal datetimes keep their CSV order
+        csv = csv.sort_values(by="Datetime", kind="stable")
+
+        keys = zip(csv["WMO Block Number"],
+                   csv["WMO Station Number"],
+                   csv["Ship or Mobile Station Identifier"])
+        for key, type_dt, sonde_type in zip(keys,
+                                            csv["Datetime"].dt.to_pydatetime(),
+                                            csv["Radiosonde Type"]):
+            datetimes, types = self.stations.setdefault(
+                SondeTypeIndex._normalise_key(*key), ([], []))
+            datetimes.append(type_dt)
+            types.append(sonde_type)
+
+    @staticmethod
+    def _normalise_id(value):
+        # "MISSING" in the BUFR is empty (NaN) in the CSV
+        if value is None or value == "MISSING" or \
+                (isinstance(value, float) and isnan(value)):
+            return None
+        elif isinstance(value, str):
+            return value.strip()
+        else:
+            return int(value)
+
+    @staticmethod
+    def _normalise_key(block_number, station_number,
+                       ship_or_mobile_station_number):
+        return (SondeTypeIndex._normalise_id(block_number),
+                SondeTypeIndex._normalise_id(station_number),
+                SondeTypeIndex._normalise_id(ship_or_mobile_station_number))
+
+    @staticmethod
+    def _same_month(dt1, dt2):
+        return dt1.year == dt2.year and dt1.month == dt2.month
+
+    def get_type(self, station_number, block_number,
+                 ship_or_mobile_station_number, dt):
+        """
+        Return the most recent type at or before dt in dt's month, None if
+        there isn't one.
+        """
+        station = self.stations.get(SondeTypeIndex._normalise_key(
+            block_number, station_number, ship_or_mobile_station_number))
+
+        if station is None:
+            return None
+
+        datetimes, types = station
+        i = bisect_right(datetimes, dt)
+        if i > 0 and SondeTypeIndex._same_month(datetimes[i - 1], dt):
+            return types[i - 1]
+
+        return None
+
+    def compact(self):
+        """
+        Drop the entries that don't change a station's type, keeping the
+        first of each month so get_type still knows which months the
+        station was seen in.
+        """
+        for key, (datetimes, types) in self.stations.items():
+            keep = [i for i in range(len(types))
+                    if i == 0 or types[i] != types[i - 1] or
+                    not SondeTypeIndex._same_month(datetimes[i], datetimes[i - 1])]
+
+            self.stations[key] = ([datetimes[i] for i in keep],
+                                  [types[i] for i in keep])
+
+    def save(self, output_path):
+        rows = []
+        for (block, station, ship), (datetimes, types) in self.stations.items():
+            for type_dt, sonde_type in zip(datetimes, types):
+                rows.append((block, station, ship, type_dt, sonde_type))
+
+        df = DataFrame(rows, columns=TIMELINE_COLUMNS) \
+            .sort_values(by=KEY_COLUMNS + ["Datetime"], na_position="first")
+
+        temp_path = output_path + ".temp"
+        df.to_csv(temp_path, index=False)
+        replace(temp_path, output_path)
+
+
+# SCRIPT
+def main():
+    type_csv_files = sorted(f for f in glob(join(SONDE_TYPE_DIR, SONDE_TYPE_CSV_GLOB)))
+    print("Compiling {} sonde type files".format(len(type_csv_files)))
+
+    index = SondeTypeIndex(type_csv_files)
+    index.compact()
+
+    n_changes = sum(len(types) for _, types in index.stations.values())
+    print("{} stations, {} type changes".format(len(index.stations), n_changes))
+
+    index.save(SONDE_TYPE_TIMELINE_PATH)
+    print("Saved to", SONDE_TYPE_TIMELINE_PATH)
+
+
+if __name__ == "__main__":
+    main()
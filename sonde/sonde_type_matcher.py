@@ -0,0 +1,188 @@
+# Match IGRA2 metadata sonde model strings to WMO radiosonde types.
+#
+# The regexes in igra2_sonde_type.meta_sonde_type_dict_list are compiled
+# once into a single pattern with a named group per type. Match results
+# are memoised per distinct model string and igra2-metadata.txt is parsed
+# once into a timeline of sonde types for each station.
+#
+# Documentation on the metadata format can be found at:
+#   /g/data/hd50/barra2/data/obs/igra/doc/igra2-metadata-readme.txt
+#
+# Author: Joshua Torrance
+
+# IMPORTS
+from bisect import bisect_right
+from datetime import datetime
+from functools import lru_cache
+from re import compile as re_compile
+import numpy as np
+
+from igra2_sonde_type import meta_sonde_type_dict_list
+
+
+# PARAMETERS
+IGRA_METADATA_PATH = "/g/data/hd50/barra2/data/obs/igra/doc/igra2-metadata.txt"
+
+# WMO code table 002011, 255 is missing
+MISSING_SONDE_TYPE = 255
+
+
+# CLASSES
+class SondeTypeMatcher:
+    """
+    Match sonde model strings against every type's regex in one pass.
+
+    Types are tried in list order, as with trying each regex in turn with
+    re.search, so the first type in the list that matches anywhere in the
+    model string wins.
+    """
+
+    def __init__(self, sonde_type_dict_list=meta_sonde_type_dict_list):
+        # group name: (id, name)
+        self.types = {}
+
+        alternatives = []
+        for i, d in enumerate(sonde_type_dict_list):
+            if not d["regex"]:
+                continue
+
+            group_name = "t{}".format(i)
+            self.types[group_name] = (d["id"], d["name"])
+
+            # A lookahead from the start of the string so that the earlier
+            # type wins rather than the earliest match in the string.
+            alternatives.append("(?=.*?(?P<{}>{}))".format(group_name, d["regex"]))
+
+        self.pattern = re_compile("|".join(alternatives))
+
+        # model string: (id, name) or None
+        self._memo = {}
+
+    def match(self, sonde_model):
+        """
+        Return (id, name) for sonde_model or None if no type matches.
+        """
+        try:
+            return self._memo[sonde_model]
+        except KeyError:
+            pass
+
+        m = self.pattern.match(sonde_model)
+        result = self.types[m.lastgroup] if m else None
+
+        self._memo[sonde_model] = result
+
+        return result
+
+
+class SondeTypeTimelines:
+    """
+    The sonde model change events in igra2-metadata.txt as a timeline of
+    WMO radiosonde types for each station.
+    """
+
+    def __init__(self, metadata_path=IGRA_METADATA_PATH, matcher=None):
+        self.matcher = matcher if matcher else SondeTypeMatcher()
+
+        # station code: ([datetimes], [type ids])
+        self.stations = {}
+
+        # Model strings that didn't match any type
+        self.unmatched = set()
+
+        with open(metadata_path, 'r') as f:
+            for line in f:
+                if "SONDE MODEL" not in line[11:]:
+                    continue
+
+                station_code = line[0:11]
+                dt, sonde_model = SondeTypeTimelines._parse_line(line)
+
+                match = self.matcher.match(sonde_model)
+                if match is None:
+                    self.unmatched.add(sonde_model)
+                    continue
+
+                datetimes, types = self.stations.setdefault(station_code, ([], []))
+                datetimes.append(dt)
+                types.append(match[0])
+
+        # Sort each station's events, stable to keep the file order for ties
+        for station_code, (datetimes, types) in self.stations.items():
+            order = sorted(range(len(datetimes)), key=datetimes.__getitem__)
+            self.stations[station_code] = ([datetimes[i] for i in order],
+                                           [types[i] for i in order])
+
+    @staticmethod
+    def _parse_line(line):
+        year = int(line[84:88])
+        month = int(line[89:91])
+        month = month if month != 99 else 1
+        day = int(line[92:94])
+        day = day if day != 99 else 1
+        hour = int(line[95:97])
+        hour = hour if hour != 99 else 1
+
+        dt = datetime(year=year, month=month, day=day, hour=hour)
+
+        sonde_model_before = line[123:163].strip()
+        sonde_model_after = line[168:208].strip()
+
+        if sonde_model_after and sonde_model_after != "NONE":
+            sonde_model = sonde_model_after
+        else:
+            sonde_model = sonde_model_before
+
+        return dt, sonde_model
+
+    def get_timeline(self, station_code):
+        """
+        Return a list of (datetime, type id) for the station.
+        """
+        datetimes, types = self.stations.get(station_code, ([], []))
+
+        return list(zip(datetimes, types))
+
+    def get_type(self, station_code, dt):
+        """
+        The type at dt, MISSING_SONDE_TYPE if there isn't one.
+        """
+        datetimes, types = self.stations.get(station_code, ([], []))
+
+        i = bisect_right(datetimes, dt)
+
+        return types[i - 1] if i > 0 else MISSING_SONDE_TYPE
+
+    def get_types(self, station_codes, datetimes):
+        """
+        Vectorised get_type for arrays of station codes and datetimes.
+        """
+        station_codes = np.asarray(station_codes)
+        datetimes = np.asarray(datetimes, dtype='M8[s]')
+
+        result = np.full(station_codes.shape, MISSING_SONDE_TYPE, dtype=np.int32)
+
+        for station_code in np.unique(station_codes):
+            if station_code not in self.stations:
+                continue
+
+            event_datetimes, types = self.stations[station_code]
+            event_datetimes = np.array(event_datetimes, dtype='M8[s]')
+            types = np.array(types, dtype=np.int32)
+
+            mask = station_codes == station_code
+            i = np.searchsorted(event_datetimes, datetimes[mask], side='right')
+
+            result[mask] = np.where(i > 0, types[np.maximum(i - 1, 0)],
+                                    MISSING_SONDE_TYPE)
+
+        return result
+
+
+# FUNCTIONS
+@lru_cache(maxsize=None)
+def get_sonde_type_timelines(metadata_path=IGRA_METADATA_PATH):
+    """
+    Return the SondeTypeTimelines, parsed once per process.
+    """
+    return SondeTypeTimelines(metadata_path)
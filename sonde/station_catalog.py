@@ -0,0 +1,288 @@
+# An in-memory catalog of the IGRA2 stations.
+#
+# The IGRA2 station list is parsed once into NumPy arrays so station
+# lookups don't require a grep subprocess per station. The parsed arrays
+# are cached as a .npz file which is reused for as long as the station
+# list's mtime and size are unchanged.
+#
+# Documentation on the station list format can be found at:
+#   /g/data/hd50/barra2/data/obs/igra/doc/igra2-list-format.txt
+#
+# Usage as a script, print the files whose station is in the BARRA2 region:
+#   python3 station_catalog.py /path/to/bufrs/*.bufr
+#
+# Author: Joshua Torrance
+
+# IMPORTS
+from argparse import ArgumentParser
+from functools import lru_cache
+from os import getpid, remove, replace, stat
+from os.path import basename, exists
+import numpy as np
+
+
+# PARAMETERS
+IGRA_STATION_LIST_PATH = "/g/data/hd50/barra2/data/obs/igra/doc/igra2-station-list.txt"
+
+# Location of the cached parse, can be anywhere writable.
+STATION_CACHE_PATH = "/scratch/hd50/jt4085/sonde/igra2-station-list.npz"
+
+# Mobile stations have these in place of a lat/lon
+MOBILE_LATITUDE = -98.8888
+MOBILE_LONGITUDE = -998.8888
+
+# Barra region
+BARRA_LEFT = 90.00
+BARRA_RIGHT = 210.0 - 360
+BARRA_BOTTOM = -60.00
+BARRA_TOP = 15.00
+
+# Mean radius of the Earth in km
+EARTH_RADIUS = 6371.0
+
+
+# CLASSES
+class StationCatalog:
+    """
+    The IGRA2 station list as arrays, indexed by station ID.
+
+    Mobile stations have NaN for their latitude and longitude.
+    """
+
+    def __init__(self, station_list_path=IGRA_STATION_LIST_PATH,
+                 cache_path=STATION_CACHE_PATH):
+        self.station_list_path = station_list_path
+        self.cache_path = cache_path
+
+        self.ids = None
+        self.names = None
+        self.latitude = None
+        self.longitude = None
+        self.elevation = None
+        self.first_year = None
+        self.last_year = None
+
+        self._index = {}
+
+        self._load()
+
+    def __len__(self):
+        return self.ids.size
+
+    def __contains__(self, station_code):
+        return station_code in self._index
+
+    def _load(self):
+        source_stat = stat(self.station_list_path)
+
+        arrays = None
+        if self.cache_path and exists(self.cache_path):
+            with np.load(self.cache_path) as cache:
+                if cache["source_mtime"] == source_stat.st_mtime and \
+                        cache["source_size"] == source_stat.st_size:
+                    arrays = {k: cache[k] for k in cache.files}
+
+        if arrays is None:
+            arrays = StationCatalog._parse(self.station_list_path)
+
+            if self.cache_path:
+                self._write_cache(arrays, source_stat)
+
+        self.ids = arrays["ids"]
+        self.names = arrays["names"]
+        self.latitude = arrays["latitude"]
+        self.longitude = arrays["longitude"]
+        self.elevation = arrays["elevation"]
+        self.first_year = arrays["first_year"]
+        self.last_year = arrays["last_year"]
+
+        self._index = {station_id: i for i, station_id in enumerate(self.ids.tolist())}
+
+    @staticmethod
+    def _parse(station_list_path):
+        """
+        Parse the fixed width station list, e.g.
+        ASM00094120  -12.4239  130.8925   29.0    DARWIN AIRPORT                 1943 2023  48510
+        """
+        ids, names, lat, lon, elev, first_year, last_year = \
+            [], [], [], [], [], [], []
+
+        with open(station_list_path, 'r') as f:
+            for line in f:
+                if len(line.strip()) == 0:
+                    continue
+
+                ids.append(line[0:11])
+                lat.append(float(line[12:20]))
+                lon.append(float(line[21:30]))
+                elev.append(float(line[31:37]))
+                names.append(line[41:71].strip())
+                first_year.append(int(line[72:76]))
+                last_year.append(int(line[77:81]))
+
+        lat = np.array(lat)
+        lon = np.array(lon)
+
+        # Mobile stations have no fixed location
+        lat[lat == MOBILE_LATITUDE] = np.nan
+        lon[lon == MOBILE_LONGITUDE] = np.nan
+
+        return {"ids": np.array(ids, dtype='U11'),
+                "names": np.array(names, dtype='U30'),
+                "latitude": lat,
+                "longitude": lon,
+                "elevation": np.array(elev),
+                "first_year": np.array(first_year, dtype=np.int32),
+                "last_year": np.array(last_year, dtype=np.int32)}
+
+    def _write_cache(self, arrays, source_stat):
+        # Write to a temp file and rename so a concurrent reader never
+        # sees a partial cache. The temp name is per process so concurrent
+        # jobs don't write over each other's temp file. np.savez appends
+        # .npz if it's missing.
+        temp_path = "{}.{}.temp.npz".format(self.cache_path, getpid())
+        try:
+            np.savez(temp_path,
+                     source_mtime=source_stat.st_mtime,
+                     source_size=source_stat.st_size,
+                     **arrays)
+            replace(temp_path, self.cache_path)
+        except OSError as e:
+            # Not being able to cache isn't fatal.
+            print("Unable to write station catalog cache:", e)
+            if exists(temp_path):
+                remove(temp_path)
+
+    def get_index(self, station_code):
+        """
+        Return the index of station_code, raise a ValueError if it's unknown.
+        """
+        try:
+            return self._index[station_code]
+        except KeyError:
+            raise ValueError("Station code ({}) not found.".format(station_code))
+
+    def get_indices(self, station_codes):
+        """
+        Return an array of indices for station_codes, -1 where unknown.
+        """
+        return np.array([self._index.get(c, -1) for c in station_codes],
+                        dtype=np.int64)
+
+    def get_name(self, station_code):
+        return str(self.names[self.get_index(station_code)])
+
+    def get_location(self, station_code):
+        """
+        Return lat, lon for the station, None for mobile stations.
+        """
+        i = self.get_index(station_code)
+
+        lat = self.latitude[i]
+        lon = self.longitude[i]
+
+        lat = None if np.isnan(lat) else float(lat)
+        lon = None if np.isnan(lon) else float(lon)
+
+        return lat, lon
+
+    def region_mask(self, left=BARRA_LEFT, right=BARRA_RIGHT,
+                    bottom=BARRA_BOTTOM, top=BARRA_TOP,
+                    include_mobile=True, indices=None):
+        """
+        Boolean mask of the stations inside the given region.
+
+        If left > right then the region wraps around the antimeridian.
+        Mobile stations are included if include_mobile is True. If indices
+        is given the mask is for those stations only, -1 (unknown) is False.
+        """
+        lat = self.latitude
+        lon = self.longitude
+        if indices is not None:
+            indices = np.asarray(indices)
+            lat = lat[indices]
+            lon = lon[indices]
+
+        # Normalise to -180 to 180
+        lon = (lon + 180) % 360 - 180
+
+        with np.errstate(invalid="ignore"):
+            in_lat = (bottom < lat) & (lat < top)
+            if left < right:
+                in_lon = (left < lon) & (lon < right)
+            else:
+                in_lon = (left < lon) | (lon < right)
+
+        mask = in_lat & in_lon
+
+        if include_mobile:
+            mask |= np.isnan(lat) | np.isnan(lon)
+
+        if indices is not None:
+            mask &= indices >= 0
+
+        return mask
+
+    def is_in_region(self, station_code, left=BARRA_LEFT, right=BARRA_RIGHT,
+                     bottom=BARRA_BOTTOM, top=BARRA_TOP, include_mobile=True):
+        return bool(self.region_mask(left, right, bottom, top, include_mobile,
+                                     indices=[self.get_index(station_code)])[0])
+
+    def nearest(self, lat, lon, n=1):
+        """
+        Return the IDs and distances (km) of the n stations nearest to lat/lon.
+        Mobile stations are ignored.
+        """
+        lat1 = np.radians(lat)
+        lon1 = np.radians(lon)
+        lat2 = np.radians(self.latitude)
+        lon2 = np.radians(self.longitude)
+
+        # Haversine
+        a = np.sin((lat2 - lat1) / 2) ** 2 + \
+            np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+        distance = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+        distance[np.isnan(distance)] = np.inf
+
+        order = np.argsort(distance, kind="stable")[:n]
+
+        return self.ids[order], distance[order]
+
+
+# FUNCTIONS
+@lru_cache(maxsize=None)
+def get_station_catalog(station_list_path=IGRA_STATION_LIST_PATH,
+                        cache_path=STATION_CACHE_PATH):
+    """
+    Return a StationCatalog, parsed once per process.
+    """
+    return StationCatalog(station_list_path, cache_path)
+
+
+def station_code_from_path(file_path):
+    # Files are named for their station, e.g. IDM00096655-data.bufr
+    return basename(file_path)[:11]
+
+
+# SCRIPT
+def main():
+    parser = ArgumentParser(prog="station_catalog.py",
+                            description="Print the files whose IGRA2 station "
+                                        "is inside the BARRA2 region.")
+    parser.add_argument("files", nargs="*",
+                        help="Files named for their station, "
+                             "e.g. IDM00096655-data.bufr")
+    args = parser.parse_args()
+
+    catalog = get_station_catalog()
+
+    indices = catalog.get_indices([station_code_from_path(f) for f in args.files])
+    mask = catalog.region_mask(indices=indices)
+
+    for f, in_region in zip(args.files, mask):
+        if in_region:
+            print(f)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,14 +12,16 @@ module load python3/3.8.5
 module load eccodes3
 
 # Run script
-# Threading in the script isn't working well
-# So multi-run the script itself
-echo "job number: $job_num"
-
+# The script uses a pool of $PBS_NCPUS processes and claims stations
+# with lock files so it can run alongside other jobs.
+# Submit with -v incremental=1 to only reconvert changed stations.
+# Submit with -v bin=1 to write the 6-hourly bins directly.
+# Submit with -v seed_manifest=1 to only seed the manifest.
+# Submit with -v submission=<id> so jobs with the same id skip the stations
+# any of them has finished.
 python3 \
     /g/data/hd50/jt4085/BARRA2/sonde/run_conversion.py \
-    $job_num &
-
-# Wait for the threads to close
-wait
-
+    ${incremental:+--incremental} \
+    ${bin:+--bin} \
+    ${seed_manifest:+--seed-manifest} \
+    ${submission:+--submission $submission}
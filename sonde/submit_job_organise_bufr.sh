@@ -19,42 +19,18 @@ module load eccodes3
 script_path=/g/data/hd50/jt4085/BARRA2/sonde/organise_bufr.py
 output_dir=/scratch/hd50/jt4085/sonde/data-bufr-bins
 
-temp_root_dir="temp/$start_year"
-
 # Run script for each file path supplied
 echo "files list: $files_list"
 echo "start year: $start_year"
 echo "end year: $end_year"
+echo "overwrite: $overwrite"
 
 for f in $files_list; do
     echo -e "\t$f"
 
-    # Make a temporary directory to work in.
-    # Grab the first 11 characters of the name which happen
-    #   to be the station ID
-    temp_dir="$temp_root_dir/$(basename $f | head -c11)"
-
-    echo "Creating temporary directory: $temp_dir"
-    mkdir -p $temp_dir
-
-    # Copy the file into the temp dir
-    cp $f $temp_dir
-
-    # cd into the temp dir so the scripts working files go there
-    cd $temp_dir
-
-    # Now run the script
-    #  We're in the temporary dir so . as $temp_dir is not an absolute path
-    python3 $script_path . $output_dir $start_year $end_year
-
-    # Return to the previous directory
-    echo "Returning to starting directory."
-    cd -
-
-    # Delete the temporary directory
-    echo "Deleting temporary directory."
-    rm -r $temp_dir
+    # The script reads the file once and writes its windows directly,
+    #  no working files are needed.
+    python3 $script_path $f $output_dir $start_year $end_year $overwrite
 done
 
 echo "Script finished at $(date)"
-
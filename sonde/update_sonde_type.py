@@ -4,56 +4,115 @@ from glob import glob
 from os import replace, remove
 from os.path import join, isdir, basename, exists
 from sys import path, argv
-from datetime import datetime
-from pandas import read_csv
+from datetime import datetime, timedelta
 
 # Import custom modules
 path.insert(1, "/g/data/hd50/jt4085/BARRA2/util/bufr")
 from eccodes_wrapper import BufrFile
+from sonde_type_index import SondeTypeIndex
+from bufr_windows import get_message_datetime
 
 
 ## PARAMETERS
 SONDE_TYPE_DIR = "/scratch/hd50/jt4085/sonde/sonde_types"
 SONDE_BUFR_DIR = "/scratch/hd50/jt4085/sonde/data-bufr-bins"
 
+# Buffer size for writing the updated files
+WRITE_BUFFER_SIZE = 1024 * 1024
+
 
 ## FUNCTIONS
 def get_type_for_station(station_number, block_number,
-    ship_or_mobile_station_number, dt, type_csv_file):
-    csv = read_csv(type_csv_file, parse_dates=["Datetime"])
-
-    # Handle the "MISSING" id numbers and get the matching indices from CSV
-    if station_number == "MISSING":
-        station_number_indices = csv["WMO Station Number"].isna() 
-    else:
-        station_number_indices = csv["WMO Station Number"] == station_number
-
-    if block_number == "MISSING":
-        block_number_indices = csv["WMO Block Number"].isna()
-    else:
-        block_number_indices = csv["WMO Block Number"] == block_number
-
-    if ship_or_mobile_station_number == "MISSING":
-        ship_number_indices = csv["Ship or Mobile Station Identifier"].isna()
-    else:
-        ship_number_indices = csv["Ship or Mobile Station Identifier"] == \
-            ship_or_mobile_station_number
-
-    filtered = csv[
-        station_number_indices & block_number_indices & ship_number_indices
-    ]
-
-    # Filterout all rows after dt
-    # Grab the most recent one for the most up to date type
-    filtered = filtered[filtered["Datetime"] <= dt]
-    if len(filtered) > 0:
-        latest_row = filtered.iloc[-1]
-
-        return latest_row["Radiosonde Type"]
-    
-    return None
-
-def update_type_in_bufr_file(bufr_file, type_csv_file):
+    ship_or_mobile_station_number, dt, type_index):
+    return type_index.get_type(station_number, block_number,
+                               ship_or_mobile_station_number, dt)
+
+def get_station_key_from_filename(bufr_file):
+    """
+    The (block, station) of the messages in a binned file, from its name
+    (<IGRA2 ID>-<YYYYMMDDHH00>.bufr) as sonde.py sets them. None if the
+    IGRA2 ID isn't a WMO number.
+    """
+    station_id = basename(bufr_file)[:11]
+
+    if len(station_id) != 11 or station_id[2] != 'M' or \
+            not station_id[6:11].isdigit():
+        return None
+
+    return int(station_id[6:8]), int(station_id[8:11])
+
+
+def may_need_type(msg, type_index, station_key):
+    """
+    False if, from its header alone, msg can't be given a type, i.e. there
+    isn't one for the station by the end of the message's typical hour.
+    The data section doesn't need to be unpacked.
+    """
+    if station_key is None:
+        # Can't tell without the ids in the data section
+        return True
+
+    block_number, station_number = station_key
+    dt = get_message_datetime(msg.message_id) + timedelta(minutes=59)
+
+    return type_index.get_type(station_number, block_number, None, dt) \
+        is not None
+
+
+def get_new_type(msg, type_index):
+    """
+    Return the type to set for msg, or None if it doesn't need changing.
+    """
+    sonde_type = msg.get_value("radiosondeType")
+
+    if sonde_type != "MISSING":
+        return None
+
+    station_number = msg.get_value("stationNumber")
+    block_number = msg.get_value("blockNumber")
+    ship_or_mobile_station_number = \
+        msg.get_value("shipOrMobileLandStationIdentifier")
+
+    year = msg.get_value("year")
+    month = msg.get_value("month")
+    day = msg.get_value("day")
+    hour = msg.get_value("hour")
+    minute = msg.get_value("minute")
+    dt = datetime(year=year, month=month, day=day,
+                  hour=hour, minute=minute)
+
+    new_type = get_type_for_station(station_number, block_number,
+        ship_or_mobile_station_number, dt, type_index)
+
+    if new_type is None or new_type == "MISSING":
+        # Still unknown, 255 is MISSING so leave it as it is
+        return None
+
+    print("\t\t\t\tStation Number:", station_number)
+    print("\t\t\t\tBlock Number:", block_number)
+    print("\t\t\t\tShip or Mobile Station Number:",
+        ship_or_mobile_station_number)
+    print("\t\t\t\tDatetime:", dt)
+
+    print("\t\t\t\tOld Type:", sonde_type)
+    print("\t\t\t\tNew Type:", new_type)
+    print()
+
+    return int(new_type)
+
+
+def update_type_in_bufr_file(bufr_file, type_index):
+    """
+    Set the missing radiosondeTypes in bufr_file.
+
+    The file is only rewritten if a type changes. Messages before the
+    first change are held as raw bytes and unchanged messages are copied
+    as-is rather than being re-packed. Only the messages the header keys
+    can't rule out (see may_need_type) are unpacked, radiosondeType is in
+    the data section so there's no cheaper way to read it.
+
+    Returns True if the file was updated.
+    """
     temp_out_file = bufr_file + ".temp"
 
     # Remove temp_out_file if it exists so we don't append to
@@ -61,51 +120,51 @@ def update_type_in_bufr_file(bufr_file, type_csv_file):
     if exists(temp_out_file):
         remove(temp_out_file)
 
-    with BufrFile(bufr_file) as bufr:
-        for msg in bufr.get_messages():
-            sonde_type = msg.get_value("radiosondeType")
-
-            if sonde_type != "MISSING":
-                print("\t\t\t\tSonde Type already updated.")
-            else:
-                station_number = msg.get_value("stationNumber")
-                block_number = msg.get_value("blockNumber")
-                ship_or_mobile_station_number = \
-                    msg.get_value("shipOrMobileLandStationIdentifier")
-
-                year = msg.get_value("year")
-                month = msg.get_value("month")
-                day = msg.get_value("day")
-                hour = msg.get_value("hour")
-                minute = msg.get_value("minute")
-                dt = datetime(year=year, month=month, day=day,
-                              hour=hour, minute=minute)
-
-                new_type = get_type_for_station(station_number, block_number,
-                    ship_or_mobile_station_number, dt, type_csv_file)
-
-                print("\t\t\t\tStation Number:", station_number)
-                print("\t\t\t\tBlock Number:", block_number)
-                print("\t\t\t\tShip or Mobile Station Number:",
-                    ship_or_mobile_station_number)
-                print("\t\t\t\tDatetime:", dt)
-
-                print("\t\t\t\tOld Type:", sonde_type)
-                print("\t\t\t\tNew Type:", new_type)
-                print()
-
-                if new_type is None or new_type == "MISSING":
-                    # 255 is MISSING
-                    new_type = 255
-
-                msg.set_value("radiosondeType", int(new_type))
-
-            with open(temp_out_file, 'ab') as temp_output_file:
+    unchanged_messages = []
+    temp_output_file = None
+    try:
+        station_key = get_station_key_from_filename(bufr_file)
+
+        with BufrFile(bufr_file, unpack=False) as bufr:
+            for msg in bufr.get_messages():
+                new_type = None
+                if may_need_type(msg, type_index, station_key):
+                    msg.unpack()
+                    new_type = get_new_type(msg, type_index)
+
+                if new_type is None:
+                    if temp_output_file:
+                        temp_output_file.write(msg.get_bytes())
+                    else:
+                        unchanged_messages.append(msg.get_bytes())
+                    continue
+
+                if temp_output_file is None:
+                    # First change, start writing
+                    temp_output_file = open(temp_out_file, 'wb',
+                                            buffering=WRITE_BUFFER_SIZE)
+                    for message in unchanged_messages:
+                        temp_output_file.write(message)
+                    unchanged_messages = None
+
+                msg.set_value("radiosondeType", new_type)
                 msg.write_to_file(temp_output_file)
+    except BaseException:
+        if temp_output_file:
+            temp_output_file.close()
+            remove(temp_out_file)
+        raise
+
+    if temp_output_file is None:
+        print("\t\t\t\tSonde Types already updated.")
+        return False
+
+    temp_output_file.close()
 
     # Copy the temp file to the actual file.
-    if temp_out_file:
-        replace(temp_out_file, bufr_file)
+    replace(temp_out_file, bufr_file)
+
+    return True
 
 
 ## SCRIPT
@@ -140,6 +199,9 @@ def main():
                 print("\t\tSonde type files doesn't exist!", sonde_type_file)
                 exit()
 
+            # Load the types once for the month
+            type_index = SondeTypeIndex(sonde_type_file)
+
             for dt_dir in sorted(glob(join(m_dir, "*"))):
                 if ".broken" in dt_dir:
                     # There's a bad file I can't delete
@@ -159,7 +221,7 @@ def main():
                     filename = basename(bufr_filepath)
                     print("\t\t\t" + filename)
 
-                    update_type_in_bufr_file(bufr_filepath, sonde_type_file)
+                    update_type_in_bufr_file(bufr_filepath, type_index)
 
 
 if __name__ == "__main__":
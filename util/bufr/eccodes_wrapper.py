@@ -22,10 +22,13 @@ from datetime import datetime, timezone
 
 # CLASSES
 class BufrFile:
-    def __init__(self, filepath, mode='rb', compressed=False):
+    def __init__(self, filepath, mode='rb', compressed=False, unpack=True):
+        # With unpack=False only the header keys of each message can be
+        #  read until its unpack() is called.
         self.filepath = filepath
         self.filemode = mode
         self.compressed_msg = compressed
+        self.unpack_msg = unpack
 
     def __enter__(self):
         self.file_obj = open(self.filepath, self.filemode)
@@ -36,7 +39,8 @@ class BufrFile:
         self.file_obj.close()
 
     def get_messages(self):
-        return BufrMessages(self, compressed=self.compressed_msg)
+        return BufrMessages(self, compressed=self.compressed_msg,
+                            unpack=self.unpack_msg)
 
     def get_number_messages(self):
         return ecc.codes_count_in_file(self.file_obj)
@@ -50,10 +54,11 @@ class BufrFile:
 
 
 class BufrMessages:
-    def __init__(self, bufr, compressed=False):
+    def __init__(self, bufr, compressed=False, unpack=True):
         self.parent_bufr = bufr
 
         self.compressed_msg = compressed
+        self.unpack_msg = unpack
 
         self.current_message = None
 
@@ -73,19 +78,30 @@ class BufrMessages:
         else:
             self.current_message = BufrMessage(self.parent_bufr,
                                                new_message_id,
-                                               compressed=self.compressed_msg)
+                                               compressed=self.compressed_msg,
+                                               unpack=self.unpack_msg)
 
             return self.current_message
 
 
 class BufrMessage:
-    def __init__(self, bufr, message_id, compressed=False):
+    def __init__(self, bufr, message_id, compressed=False, unpack=True):
         self.parent_bufr = bufr
         self.message_id = message_id
 
         if compressed:
             ecc.codes_set(self.message_id, 'compressedData', 1)
 
+        if unpack:
+            self.unpack()
+
+    def unpack(self, skip_attributes=False):
+        # Decode the data section. skip_attributes doesn't create the
+        #  attribute keys (units, code etc.) which is quicker if only the
+        #  values are read.
+        if skip_attributes:
+            ecc.codes_set(self.message_id, 'skipExtraKeyAttributes', 1)
+
         try:
             ecc.codes_set(self.message_id, 'unpack', 1)
         except grib_errors.FunctionNotImplementedError as e:
@@ -97,6 +113,10 @@ class BufrMessage:
         ecc.codes_set(self.message_id, 'pack', 1)
         ecc.codes_write(self.message_id, file_obj)
 
+    def get_bytes(self):
+        # The encoded message, unchanged unless a value has been set
+        return ecc.codes_get_message(self.message_id)
+
     def get_attributes(self):
         return BufrAttributes(self)
 